@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2017, 2021  Rickard Lindberg
+#
+# This file is part of rlselect.
+#
+# rlselect is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rlselect is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rlselect.  If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+import rlselect
+
+USAGE = """\
+I measure how rlselect scales.
+
+Usage:
+  {name} [--startup] [--sizes <n,...>] [--corpora <name,...>] [--engines <name,...>] [--output <path>] [--baseline <path>] [--tolerance <fraction>]
+  {name} (-h | --help)
+
+Options:
+  --startup               Only measure startup time.
+  --sizes <n,...>         Number of lines in each corpus [default: 10000,100000,1000000].
+  --corpora <name,...>    Corpora to generate: history, paths, logs [default: all].
+  --engines <name,...>    Search engines: substring, index, fuzzy [default: substring,fuzzy].
+  --output <path>         Where to write results as JSON [default: bench_output.txt].
+  --baseline <path>       Compare results with an earlier output and exit with
+                          failure if anything regressed.
+  --tolerance <fraction>  How much worse than the baseline a result may be
+                          before it is a regression [default: 0.25].
+  -h,  --help             Show this message and exit.
+""".format(
+    name=os.path.basename(__file__)
+)
+
+CORPORA = ("history", "paths", "logs")
+ENGINES = ("substring", "index", "fuzzy")
+
+# Queries are typed one character at a time, and then erased again.
+QUERIES = {
+    "history": "git commit -m",
+    "paths": "src test py",
+    "logs": "error timeout",
+}
+
+SCREEN_SIZE = (50, 200)
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(DIRECTORY, "rlselect.py")
+
+COMMANDS = [
+    "git status", "git commit -m", "git push origin", "git log --oneline",
+    "ls -la", "cd", "vim", "make", "python3 -m pytest", "grep -rn",
+    "docker run --rm -it", "ssh", "curl -s", "find . -name", "tail -f",
+]
+WORDS = [
+    "src", "lib", "test", "docs", "build", "main", "util", "config", "core",
+    "server", "client", "model", "view", "handler", "parser", "cache",
+]
+EXTENSIONS = [".py", ".c", ".h", ".js", ".md", ".txt", ".json", ".sh"]
+LEVELS = ["DEBUG", "INFO", "INFO", "INFO", "WARNING", "ERROR"]
+MESSAGES = [
+    "request completed", "connection timeout", "retrying request",
+    "cache miss", "error reading response", "user logged in",
+]
+
+def main():
+    args = parse_args()
+    if args["-h"] or args["--help"]:
+        usage()
+        sys.exit(0)
+    if args["--worker"] is not None:
+        corpus, size, engines = args["--worker"]
+        print(json.dumps(run_worker(corpus, size, engines)))
+        return
+    results = {
+        "python": sys.version.split()[0],
+        "startup_seconds": measure_startup([SCRIPT, "--help"]),
+        "startup_import_seconds": measure_startup([
+            "-c",
+            "import rlselect",
+        ]),
+        "runs": [],
+    }
+    for corpus in [] if args["--startup"] else args["--corpora"]:
+        for size in args["--sizes"]:
+            print("{} {:,} lines".format(corpus, size), file=sys.stderr)
+            # Every run is a new process so that peak memory is its own.
+            output = subprocess.check_output([
+                sys.executable,
+                __file__,
+                "--worker",
+                corpus,
+                str(size),
+                ",".join(args["--engines"]),
+            ])
+            results["runs"].append(json.loads(output))
+    with open(args["--output"], "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print_results(results)
+    if args["--baseline"] is not None:
+        with open(args["--baseline"]) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, args["--tolerance"])
+        for regression in regressions:
+            print("REGRESSION {}".format(regression))
+        if regressions:
+            sys.exit(1)
+
+def run_worker(corpus, size, engines):
+    data = generate(corpus, size).encode("utf-8")
+    start = time.perf_counter()
+    lines = rlselect.Lines.from_stream(
+        io.TextIOWrapper(io.BytesIO(data), encoding="utf-8")
+    )
+    ingest_seconds = time.perf_counter() - start
+    result = {
+        "corpus": corpus,
+        "size": size,
+        "unique_lines": lines.count(),
+        "ingest_seconds": ingest_seconds,
+        "ingest_lines_per_second": size / ingest_seconds,
+        "ingest_bytes_per_second": len(data) / ingest_seconds,
+        "engines": {},
+    }
+    del data
+    for engine in engines:
+        result["engines"][engine] = measure_typing(
+            lines,
+            QUERIES[corpus],
+            get_search_fn(engine, lines)
+        )
+    result["peak_memory_bytes"] = get_peak_memory()
+    return result
+
+def measure_startup(args, repeat=10):
+    # The first run compiles and caches the bytecode of imported modules.
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    command = [sys.executable] + args
+    subprocess.check_output(command, cwd=DIRECTORY, env=env)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.check_output(command, cwd=DIRECTORY, env=env)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def measure_typing(lines, query, search_fn):
+    screen = NullScreen(*SCREEN_SIZE)
+    controller = rlselect.UiController(lines, "", search_fn, False, False)
+    controller.setup(screen)
+    finish(controller, screen)
+    # A keystroke is done when the first frame after it is rendered, and a
+    # search is done when all its matches needed for the screen are found.
+    keystroke_timings = []
+    search_timings = []
+    render_timings = []
+    keys = list(query) + [rlselect.BS] * len(query)
+    for key in keys:
+        start = time.perf_counter()
+        controller.process_input(key)
+        render_start = time.perf_counter()
+        controller.render(screen)
+        end = time.perf_counter()
+        keystroke_timings.append(end - start)
+        render_timings.append(end - render_start)
+        finish(controller, screen)
+        search_timings.append(time.perf_counter() - start)
+    return {
+        "keystroke_seconds": summarize(keystroke_timings),
+        "search_seconds": summarize(search_timings),
+        "render_seconds": summarize(render_timings),
+    }
+
+def finish(controller, screen):
+    while controller.update():
+        controller.render(screen)
+
+def get_search_fn(engine, lines):
+    if engine == "index":
+        return rlselect.TrigramIndex(lines).search
+    elif engine == "fuzzy":
+        return rlselect.FuzzySearch()
+    else:
+        return rlselect.MultiTermSearch()
+
+def summarize(timings):
+    timings = sorted(timings)
+    return {
+        "min": timings[0],
+        "median": percentile(timings, 0.5),
+        "p90": percentile(timings, 0.9),
+        "p99": percentile(timings, 0.99),
+        "max": timings[-1],
+    }
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(
+        len(sorted_values) - 1,
+        int(round(fraction * (len(sorted_values) - 1)))
+    )]
+
+def get_peak_memory():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak
+    else:
+        return peak * 1024
+
+class NullScreen(object):
+
+    def __init__(self, height, width):
+        self._size = (height, width)
+
+    def getmaxyx(self):
+        return self._size
+
+    def erase(self):
+        pass
+
+    def addstr(self, y, x, text, style):
+        pass
+
+    def refresh(self):
+        pass
+
+def generate(corpus, size):
+    # The same corpus is generated every time so that runs can be compared.
+    rng = random.Random(corpus)
+    if corpus == "history":
+        line_fn = generate_history_line
+    elif corpus == "paths":
+        line_fn = generate_path_line
+    else:
+        line_fn = generate_log_line
+    return "".join(line_fn(rng, index) + "\n" for index in range(size))
+
+def generate_history_line(rng, index):
+    return "{} {}{}".format(
+        rng.choice(COMMANDS),
+        "/".join(rng.sample(WORDS, rng.randint(0, 3))),
+        rng.choice(EXTENSIONS) if rng.random() < 0.5 else " {}".format(
+            rng.randrange(index + 1)
+        )
+    )
+
+def generate_path_line(rng, index):
+    return "{}/{}_{}{}".format(
+        "/".join(rng.sample(WORDS, rng.randint(1, 6))),
+        rng.choice(WORDS),
+        index,
+        rng.choice(EXTENSIONS)
+    )
+
+def generate_log_line(rng, index):
+    return "2021-{:02}-{:02}T{:02}:{:02}:{:02} {} [{}] {}: {}".format(
+        rng.randint(1, 12),
+        rng.randint(1, 28),
+        rng.randrange(24),
+        rng.randrange(60),
+        rng.randrange(60),
+        rng.choice(LEVELS),
+        rng.choice(WORDS),
+        rng.choice(MESSAGES),
+        " ".join(
+            "{}={}".format(rng.choice(WORDS), rng.randrange(100000))
+            for _
+            in range(rng.randint(5, 40))
+        )
+    )
+
+def compare(baseline, results, tolerance):
+    regressions = []
+    old_metrics = flatten(baseline)
+    for name, value in sorted(flatten(results).items()):
+        old_value = old_metrics.get(name)
+        if not isinstance(old_value, (int, float)) or old_value <= 0:
+            continue
+        if name.endswith("_per_second"):
+            change = (old_value - value) / old_value
+        else:
+            change = (value - old_value) / old_value
+        if change > tolerance:
+            regressions.append("{}: {:.6g} -> {:.6g} ({:+.0%})".format(
+                name,
+                old_value,
+                value,
+                change
+            ))
+    return regressions
+
+def flatten(results):
+    metrics = {
+        "startup_seconds": results["startup_seconds"],
+        "startup_import_seconds": results.get("startup_import_seconds"),
+    }
+    for run in results["runs"]:
+        prefix = "{}/{}/".format(run["corpus"], run["size"])
+        for name in [
+            "ingest_seconds",
+            "ingest_lines_per_second",
+            "ingest_bytes_per_second",
+            "peak_memory_bytes",
+        ]:
+            metrics[prefix + name] = run[name]
+        for engine, timings in run["engines"].items():
+            for name, summary in timings.items():
+                for statistic in ["median", "p90"]:
+                    metrics["{}{}/{}.{}".format(
+                        prefix,
+                        engine,
+                        name,
+                        statistic
+                    )] = summary[statistic]
+    return metrics
+
+def print_results(results):
+    print("startup {:.1f} ms, import {:.1f} ms".format(
+        results["startup_seconds"] * 1000,
+        results["startup_import_seconds"] * 1000
+    ))
+    for run in results["runs"]:
+        print("{} {:,} lines: ingest {:,.0f} lines/s, peak {:.0f} MB".format(
+            run["corpus"],
+            run["size"],
+            run["ingest_lines_per_second"],
+            run["peak_memory_bytes"] / 1024 / 1024
+        ))
+        for engine, timings in sorted(run["engines"].items()):
+            print("  {:<10} {} {}".format(
+                engine,
+                format_timings("keystroke", timings["keystroke_seconds"]),
+                format_timings("search", timings["search_seconds"])
+            ))
+
+def format_timings(name, summary):
+    return "{} median {:.1f} ms p90 {:.1f} ms".format(
+        name,
+        summary["median"] * 1000,
+        summary["p90"] * 1000
+    )
+
+def parse_args():
+    args = {
+        "-h": False,
+        "--help": False,
+        "--startup": False,
+        "--sizes": [10000, 100000, 1000000],
+        "--corpora": list(CORPORA),
+        "--engines": ["substring", "fuzzy"],
+        "--output": "bench_output.txt",
+        "--baseline": None,
+        "--tolerance": 0.25,
+        "--worker": None,
+    }
+    rest = sys.argv[1:]
+    if rest == ["-h"]:
+        args["-h"] = True
+        rest = []
+    if rest == ["--help"]:
+        args["--help"] = True
+        rest = []
+    while rest:
+        if rest[:1] == ["--startup"]:
+            args["--startup"] = True
+            rest = rest[1:]
+        elif rest[:1] == ["--sizes"] and len(rest) > 1:
+            args["--sizes"] = [int(size) for size in rest[1].split(",")]
+            rest = rest[2:]
+        elif rest[:1] == ["--corpora"] and len(rest) > 1:
+            args["--corpora"] = check_names(rest[1].split(","), CORPORA)
+            rest = rest[2:]
+        elif rest[:1] == ["--engines"] and len(rest) > 1:
+            args["--engines"] = check_names(rest[1].split(","), ENGINES)
+            rest = rest[2:]
+        elif rest[:1] == ["--output"] and len(rest) > 1:
+            args["--output"] = rest[1]
+            rest = rest[2:]
+        elif rest[:1] == ["--baseline"] and len(rest) > 1:
+            args["--baseline"] = rest[1]
+            rest = rest[2:]
+        elif rest[:1] == ["--tolerance"] and len(rest) > 1:
+            args["--tolerance"] = float(rest[1])
+            rest = rest[2:]
+        elif rest[:1] == ["--worker"] and len(rest) > 3:
+            args["--worker"] = (rest[1], int(rest[2]), rest[3].split(","))
+            rest = rest[4:]
+        else:
+            usage()
+            sys.exit(1)
+    return args
+
+def check_names(names, valid_names):
+    for name in names:
+        if name not in valid_names:
+            usage()
+            sys.exit(1)
+    return names
+
+def usage():
+    print(USAGE.strip())
+
+if __name__ == "__main__":
+    main()
@@ -17,66 +17,88 @@
 # You should have received a copy of the GNU General Public License
 # along with rlselect.  If not, see <http://www.gnu.org/licenses/>.
 
+from array import array
+from bisect import bisect_left
+from bisect import bisect_right
 from collections import namedtuple
-from configparser import RawConfigParser
+from collections import OrderedDict
+from itertools import accumulate
+from itertools import chain
 from itertools import islice
+from itertools import repeat
+import atexit
+import codecs
+import contextlib
+import heapq
 import locale
+import marshal
+import operator
 import os
+import re
 import sys
 import io
+import threading
+import time
 
 
 class Config(object):
 
-    def __init__(self, path=None):
-        self._config_parser = RawConfigParser()
-        self._config_parser.add_section("theme")
-        self._config_parser.set("theme", "highlight_fg", "RED")
-        self._config_parser.set("theme", "highlight_bg", "BACKGROUND")
-        self._config_parser.set("theme", "selection_fg", "WHITE")
-        self._config_parser.set("theme", "selection_bg", "GREEN")
-        self._config_parser.set("theme", "gui_font_size", "11")
-        self._config_parser.set("theme", "gui_size", "900, 648")
-        self._config_parser.add_section("rgb")
-        self._config_parser.set("rgb", "BACKGROUND", "253, 246, 227")
-        self._config_parser.set("rgb", "FOREGROUND", "101, 123, 131")
-        self._config_parser.set("rgb", "BLACK", "7, 54, 66")
-        self._config_parser.set("rgb", "BLUE", "38, 139, 210")
-        self._config_parser.set("rgb", "CYAN", "42, 161, 152")
-        self._config_parser.set("rgb", "GREEN", "133, 153, 0")
-        self._config_parser.set("rgb", "MAGENTA", "211, 54, 130")
-        self._config_parser.set("rgb", "RED", "220, 50, 47")
-        self._config_parser.set("rgb", "WHITE", "238, 232, 213")
-        self._config_parser.set("rgb", "YELLOW", "181, 137, 0")
+    # Values are keyed by section and lowercase name, like in
+    # RawConfigParser, which is only needed to read a config file.
+
+    DEFAULTS = {
+        ("theme", "highlight_fg"): "RED",
+        ("theme", "highlight_bg"): "BACKGROUND",
+        ("theme", "selection_fg"): "WHITE",
+        ("theme", "selection_bg"): "GREEN",
+        ("theme", "gui_font_size"): "11",
+        ("theme", "gui_size"): "900, 648",
+        ("rgb", "background"): "253, 246, 227",
+        ("rgb", "foreground"): "101, 123, 131",
+        ("rgb", "black"): "7, 54, 66",
+        ("rgb", "blue"): "38, 139, 210",
+        ("rgb", "cyan"): "42, 161, 152",
+        ("rgb", "green"): "133, 153, 0",
+        ("rgb", "magenta"): "211, 54, 130",
+        ("rgb", "red"): "220, 50, 47",
+        ("rgb", "white"): "238, 232, 213",
+        ("rgb", "yellow"): "181, 137, 0",
+    }
+
+    def __init__(self, path=None, cache_path=None):
+        self._values = dict(self.DEFAULTS)
         if path is not None:
-            self._config_parser.read([path])
+            self._values.update(read_config(path, cache_path))
 
     def get_highlight_fg(self):
-        return self._config_parser.get("theme", "highlight_fg")
+        return self._get("theme", "highlight_fg")
 
     def get_highlight_bg(self):
-        return self._config_parser.get("theme", "highlight_bg")
+        return self._get("theme", "highlight_bg")
 
     def get_selection_fg(self):
-        return self._config_parser.get("theme", "selection_fg")
+        return self._get("theme", "selection_fg")
 
     def get_selection_bg(self):
-        return self._config_parser.get("theme", "selection_bg")
+        return self._get("theme", "selection_bg")
 
     def get_rgb(self, name):
         return self._get_int_tuple("rgb", name, 3)
 
     def get_gui_font_size(self):
-        return self._config_parser.getint("theme", "gui_font_size")
+        return int(self._get("theme", "gui_font_size"))
 
     def get_gui_size(self):
         return self._get_int_tuple("theme", "gui_size", 2)
 
+    def _get(self, section, name):
+        return self._values[(section, name.lower())]
+
     def _get_int_tuple(self, section, name, size):
         result = tuple(
             int(x.strip())
             for x
-            in self._config_parser.get(section, name).split(",")
+            in self._get(section, name).split(",")
         )
         if len(result) != size:
             raise ValueError("Expected {} integers but got {} for {}".format(
@@ -86,66 +108,816 @@ class Config(object):
             ))
         return result
 
-def search(lines, expression):
-    match = get_match_fn(expression)
-    for index, line in lines.iter():
-        result = match(line)
-        if result is not None:
-            yield (index, marks_to_ranges(result))
+def read_config(path, cache_path=None):
+    # The parsed values are cached for as long as the config file is
+    # unchanged, so that configparser is not imported at every start.
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return {}
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    cached = read_cache(cache_path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    from configparser import RawConfigParser
+    config_parser = RawConfigParser()
+    config_parser.read([path])
+    values = {
+        (section, name): value
+        for section
+        in config_parser.sections()
+        for (name, value)
+        in config_parser.items(section)
+    }
+    if cache_path is not None:
+        write_cache(cache_path, (key, values))
+    return values
+
+def read_cache(path):
+    if path is None:
+        return None
+    try:
+        with open(path, "rb") as f:
+            return marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+
+def write_cache(path, value):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = "{}.{}".format(path, os.getpid())
+        with open(temporary_path, "wb") as f:
+            marshal.dump(value, f)
+        os.replace(temporary_path, path)
+    except OSError:
+        # Without a cache, values are just read again next time.
+        pass
+
+def get_history_cache_path(path):
+    return os.path.join(
+        get_cache_dir(),
+        "history" + os.path.abspath(path).replace(os.sep, "%")
+    )
+
+def get_cache_dir():
+    return os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+        "rlselect"
+    )
 
-def get_match_fn(expression):
-    def match(line):
+class Stats(object):
+
+    # Records how long each phase takes, and the memory in use and the peak
+    # memory after it, as JSON lines. Nothing is recorded unless a file is
+    # opened.
+
+    def __init__(self):
+        self._file = None
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+
+    def open(self, path):
+        import json
+        self._dumps = json.dumps
+        self._file = open(path, "w")
+        atexit.register(self._file.close)
+
+    @contextlib.contextmanager
+    def time(self, phase, **fields):
+        if self._file is None:
+            yield fields
+            return
+        start = time.monotonic()
+        yield fields
+        fields["phase"] = phase
+        fields["start"] = start - self._start
+        fields["seconds"] = time.monotonic() - start
+        fields["memory_bytes"] = get_current_memory()
+        fields["peak_memory_bytes"] = get_peak_memory()
+        line = self._dumps(fields, sort_keys=True)
+        # Lines are read in a background thread.
+        with self._lock:
+            self._file.write(line + "\n")
+
+STATS = Stats()
+
+def get_peak_memory():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak
+    else:
+        return peak * 1024
+
+def get_current_memory():
+    # The peak only grows, so it can't tell what a later phase freed.
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE")
+
+def search(lines, expression, indices=None):
+    for index in find_matches(lines, expression, indices):
+        yield (index, highlight(lines, expression, index))
+
+def find_matches(lines, expression, indices=None):
+    if indices is None:
+        indices = range(lines.count())
+    elif not isinstance(indices, range):
+        indices = list(indices)
+    if expression == expression.lower():
+        # Lowercase expressions are matched against the folded lines.
+        expression = lines.fold_expression(expression)
+        iter_lines = lines.iter_folded
+    else:
+        iter_lines = lines.iter
+    # The first candidates decide in which order terms are checked.
+    (_, condition, names) = compile_query(
+        expression,
+        folded=True,
+        sample=[line for (_, line) in iter_lines(indices[:QUERY_SAMPLE_SIZE])]
+    )
+    select = compile_query_fn(
+        "(index for (index, line) in candidates if {})".format(condition),
+        "candidates",
+        names
+    )
+    return select(iter_lines(indices))
+
+def highlight(lines, expression, index):
+    if expression == expression.lower():
+        ranges = get_highlight_fn(
+            lines.fold_expression(expression),
+            folded=True
+        )(lines.get_folded(index))
+        return lines.map_folded_ranges(index, ranges)
+    else:
+        return get_highlight_fn(expression)(lines.get(index))
+
+def get_match_fn(expression, folded=False, sample=()):
+    (lower, condition, names) = compile_query(expression, folded, sample)
+    match = compile_query_fn(condition, "line", names)
+    if lower:
+        return lambda line: match(line.lower())
+    return match
+
+QUERY_SAMPLE_SIZE = 100
+
+def compile_query(expression, folded=False, sample=()):
+    # An expression is compiled to one condition on line, with negation and
+    # escaping resolved up front. Terms that fewest sample lines contain,
+    # and then longer terms, are checked first, so that most lines are
+    # rejected by the first check.
+    ignore_case, positive, negative = split_terms(expression)
+    lower = ignore_case and not folded
+    if lower:
+        sample = [line.lower() for line in sample]
+    def frequency(term):
+        return sum(1 for line in sample if term in line)
+    names = {}
+    def name(term):
+        term_name = "t{}".format(len(names))
+        names[term_name] = term
+        return term_name
+    conditions = []
+    for term in sorted(
+        dict.fromkeys(positive),
+        key=lambda term: (frequency(term), -len(term))
+    ):
+        conditions.append("{} in line".format(name(term)))
+    for term in sorted(
+        dict.fromkeys(negative),
+        key=lambda term: -frequency(term[1:])
+    ):
+        # If the term after exclamation char is in line, the line only
+        # matches if it contains the whole term.
+        conditions.append("({} not in line or {} in line)".format(
+            name(term[1:]),
+            name(term)
+        ))
+    return (lower, " and ".join(conditions) or "True", names)
+
+def compile_query_fn(body, argument, names):
+    # Terms are bound in a closure, which is faster to look up than globals.
+    return eval("lambda {}: lambda {}: {}".format(
+        ", ".join(names),
+        argument,
+        body
+    ))(**names)
+
+def get_highlight_fn(expression, folded=False):
+    def highlight(line):
         if ignore_case:
             line = line.lower()
-        marks = set()
+        ranges = []
         for term, term_len in terms:
-            # Negative matching..
-            if term[0] == '!':
-                # A single exclamation char always matches
-                if term == '!':
-                    continue
-                # A double exclamation string means match for single exclamation char
-                elif term.startswith('!!'):
-                    term = term[1:]
-                else:
-                    # If the term after exclamation char is not in line..
-                    # we have a match, so continue matching.
-                    if term[1:] not in line:
-                        continue
-            if term in line:
-                index = line.find(term)
-                while index != -1:
-                    marks.update(range(index, index+term_len))
-                    index = line.find(term, index+term_len)
-            else:
-                # If one term doesn't match, the expression doesn't match.
-                return None
-        return marks
+            index = line.find(term)
+            while index != -1:
+                ranges.append((index, index+term_len))
+                index = line.find(term, index+term_len)
+        return merge_ranges(ranges)
+    ignore_case = not folded and expression == expression.lower()
+    terms = []
+    for term in expression.split():
+        # A single exclamation char always matches
+        if term == '!':
+            continue
+        # A double exclamation string means match for single exclamation
+        # char. The length of the original term is highlighted.
+        elif term.startswith('!!'):
+            terms.append((term[1:], len(term)))
+        # A negative term is only found in matching lines if the whole term
+        # is in the line, so it is highlighted like a positive term.
+        else:
+            terms.append((term, len(term)))
+    return highlight
+
+def is_refinement(old_expression, new_expression):
+    # True if every line matching new_expression also matches old_expression.
+    # A refined search then only has to look at what the old one matched.
+    old_ignore_case, old_positive, old_negative = split_terms(old_expression)
+    new_ignore_case, new_positive, new_negative = split_terms(new_expression)
+    if old_ignore_case != new_ignore_case:
+        # A case sensitive expression is never narrowed by an ignore case
+        # one. Negative terms must be compared in the same case mode.
+        if not old_ignore_case or old_negative:
+            return False
+    for old_term in old_positive:
+        if not any(
+            old_term in (new_term.lower() if old_ignore_case else new_term)
+            for new_term
+            in new_positive
+        ):
+            return False
+    for old_term in old_negative:
+        if old_term not in new_negative:
+            return False
+    return True
+
+def split_terms(expression):
     ignore_case = expression == expression.lower()
-    terms = [(term, len(term)) for term in expression.split()]
-    return match
+    positive = []
+    negative = []
+    for term in expression.split():
+        if term == '!':
+            continue
+        elif term.startswith('!!'):
+            positive.append(term[1:])
+        elif term[0] == '!':
+            negative.append(term)
+        else:
+            positive.append(term)
+    return (ignore_case, positive, negative)
+
+FOLD_MODES = ("lower", "casefold", "accents")
 
-def marks_to_ranges(marks):
+class Folder(object):
+
+    # Folds lines for lowercase searches. Where folding changes the length
+    # of a line, a mapping from folded to original positions is returned
+    # so that highlights can be put on the original line.
+
+    def __init__(self, mode="lower"):
+        self.mode = mode
+        if mode == "lower":
+            self._fold_text = str.lower
+        elif mode == "casefold":
+            self._fold_text = str.casefold
+        elif mode == "accents":
+            self._fold_text = strip_accents
+        else:
+            raise ValueError("Unknown fold mode {}".format(mode))
+
+    def fold_expression(self, expression):
+        return self._fold_text(expression)
+
+    def fold(self, line):
+        if line.isascii():
+            return (line.lower(), None)
+        folded = self._fold_text(line)
+        if len(folded) == len(line) and self.mode != "accents":
+            return (folded, None)
+        parts = [self._fold_text(character) for character in line]
+        folded = "".join(parts)
+        if len(folded) == len(line) and all(len(part) == 1 for part in parts):
+            return (folded, None)
+        return (folded, array("I", chain.from_iterable(
+            repeat(index, len(part))
+            for (index, part)
+            in enumerate(parts)
+        )))
+
+def strip_accents(text):
+    import unicodedata
+    return "".join(
+        character
+        for character
+        in unicodedata.normalize("NFKD", text.casefold())
+        if not unicodedata.combining(character)
+    )
+
+def map_folded_ranges(ranges, mapping):
+    return merge_ranges(
+        (mapping[start], map_end(end, mapping))
+        for (start, end)
+        in ranges
+    )
+
+def map_end(end, mapping):
+    if end > len(mapping):
+        # Highlights of double exclamation terms can reach past the line.
+        return mapping[-1] + 1 + end - len(mapping)
+    else:
+        return mapping[end-1] + 1
+
+def merge_ranges(ranges):
     result = []
-    start = None
-    end = None
-    for mark in sorted(marks):
-        if start is None:
-            start = mark
-            end = start + 1
-        elif mark > end:
-            result.append((start, end))
-            start = mark
-            end = start + 1
+    for start, end in sorted(ranges):
+        if result and start <= result[-1][1]:
+            if end > result[-1][1]:
+                result[-1] = (result[-1][0], end)
         else:
-            end = mark + 1
-    if start is not None:
-        result.append((start, end))
+            result.append((start, end))
     return result
 
+class MultiTermSearch(object):
+
+    # Finds matching lines in one pass over the utf-8 buffer of the lines,
+    # with one pattern for all terms. Only lines where a term is found are
+    # looked at, so lines without any term are never decoded. When many
+    # lines contain a term, matching them one by one is faster, so that is
+    # done for the rest of the block.
+
+    MIN_SCANNED_LINES = 100
+    MAX_HIT_RATIO = 0.1
+
+    def __init__(self):
+        self._matcher = None
+
+    def __call__(self, lines, expression, indices=None):
+        if indices is None:
+            indices = range(lines.count())
+        folded = expression == expression.lower()
+        buffer = None
+        if isinstance(indices, range) and len(indices) > 0:
+            buffer = lines.get_buffer(indices.stop, folded)
+        if buffer is None:
+            return find_matches(lines, expression, indices)
+        matcher = self._get_matcher(
+            lines.fold_expression(expression) if folded else expression
+        )
+        if matcher.search is None:
+            return find_matches(lines, expression, indices)
+        return self._scan(lines, expression, matcher, buffer, indices)
+
+    def _scan(self, lines, expression, matcher, buffer, indices):
+        (text, offsets) = buffer
+        line = indices.start
+        position = offsets[line]
+        end = offsets[indices.stop]
+        hit_lines = 0
+        while True:
+            match = matcher.search(text, position, end)
+            if match is None:
+                hit_line = indices.stop
+            else:
+                hit_line = bisect_right(
+                    offsets, match.start(), line, indices.stop
+                ) - 1
+            if matcher.matches_without_terms:
+                yield from range(line, hit_line)
+            if match is None:
+                return
+            if matcher.decide(text, match.start(), offsets[hit_line+1] - 1):
+                yield hit_line
+            line = hit_line + 1
+            position = offsets[line]
+            hit_lines += 1
+            scanned = line - indices.start
+            if (scanned >= self.MIN_SCANNED_LINES and
+                    hit_lines > scanned * self.MAX_HIT_RATIO):
+                yield from find_matches(
+                    lines,
+                    expression,
+                    range(line, indices.stop)
+                )
+                return
+
+    def _get_matcher(self, expression):
+        if self._matcher is None or self._matcher.expression != expression:
+            self._matcher = TermMatcher(expression)
+        return self._matcher
+
+class TermMatcher(object):
+
+    # All terms of an expression, encoded, in one pattern. Longer terms are
+    # tried first, so a term found at a position is the longest one there,
+    # and the shorter terms found with it are its prefixes.
+
+    def __init__(self, expression):
+        self.expression = expression
+        _, positive, negative = split_terms(expression)
+        self._positive = set(self._encode(term) for term in positive)
+        self._negative = [
+            (self._encode(term[1:]), self._encode(term))
+            for term
+            in negative
+        ]
+        terms = sorted(
+            self._positive.union(*self._negative),
+            key=len,
+            reverse=True
+        )
+        if not terms:
+            # Every line matches.
+            self.search = None
+            return
+        pattern = b"|".join(re.escape(term) for term in terms)
+        self.search = re.compile(pattern).search
+        self._findall = re.compile(b"(?=(" + pattern + b"))").findall
+        self._prefixes = dict(
+            (term, set(prefix for prefix in terms if term.startswith(prefix)))
+            for term
+            in terms
+        )
+        self._decisions = {}
+        self.matches_without_terms = not self._positive
+
+    def decide(self, text, start, end):
+        # Lines with the same terms are decided the same way.
+        found = frozenset(self._findall(text, start, end))
+        if found not in self._decisions:
+            self._decisions[found] = self._decide(found)
+        return self._decisions[found]
+
+    def _decide(self, found):
+        terms = set().union(*(self._prefixes[term] for term in found))
+        if not self._positive.issubset(terms):
+            return False
+        for term, whole_term in self._negative:
+            # Like in get_match_fn, the term after the exclamation char
+            # only excludes the line if the whole term is not there.
+            if term in terms and whole_term not in terms:
+                return False
+        return True
+
+    def _encode(self, term):
+        return term.encode(*Lines.ENCODING)
+
+class TrigramIndex(object):
+
+    # Lines that contain all trigrams of the positive terms are the only
+    # candidates for a match. They are still verified with search.
+
+    # Lines are indexed a few chunks at a time when they are searched, until
+    # the time of a search slice is used. Lines after the indexed ones are
+    # searched without the index.
+    INDEX_CHUNK_SIZE = 256
+
+    def __init__(self, lines):
+        self._lines = lines
+        self._postings = {True: {}, False: {}}
+        self._indexed_counts = {True: 0, False: 0}
+
+    def search(self, lines, expression, indices=None):
+        if indices is None:
+            indices = range(lines.count())
+        ignore_case = expression == expression.lower()
+        if ignore_case:
+            _, positive, _ = split_terms(lines.fold_expression(expression))
+        else:
+            _, positive, _ = split_terms(expression)
+        trigrams = set(
+            term[i:i+3]
+            for term
+            in positive
+            for i
+            in range(len(term) - 2)
+        )
+        if trigrams:
+            indices = self._filter(indices, trigrams, ignore_case)
+        return find_matches(lines, expression, indices)
+
+    def _filter(self, indices, trigrams, ignore_case):
+        if not isinstance(indices, range):
+            indices = list(indices)
+        if len(indices) == 0:
+            return []
+        # Indices are always in ascending order.
+        start = indices[0]
+        postings = self._get_postings(
+            ignore_case,
+            indices[-1] + 1,
+            time.monotonic() + SEARCH_SLICE_SECONDS
+        )
+        end = self._indexed_counts[ignore_case]
+        if end <= start:
+            return indices
+        unindexed = indices[bisect_left(indices, end):]
+        result = None
+        for trigram in trigrams:
+            posting = postings.get(trigram, ())
+            part = posting[
+                bisect_left(posting, start):bisect_left(posting, end)
+            ]
+            if result is None:
+                result = set(part)
+            else:
+                result = result.intersection(part)
+            if not result:
+                break
+        if isinstance(indices, range):
+            return sorted(result) + list(unindexed)
+        else:
+            return [
+                index
+                for index
+                in indices[:len(indices)-len(unindexed)]
+                if index in result
+            ] + unindexed
+
+    def _get_postings(self, ignore_case, end, deadline):
+        postings = self._postings[ignore_case]
+        while self._indexed_counts[ignore_case] < end:
+            start = self._indexed_counts[ignore_case]
+            chunk = range(start, min(end, start + self.INDEX_CHUNK_SIZE))
+            if ignore_case:
+                lines = self._lines.iter_folded(chunk)
+            else:
+                lines = self._lines.iter(chunk)
+            for index, line in lines:
+                for trigram in {line[i:i+3] for i in range(len(line) - 2)}:
+                    posting = postings.get(trigram)
+                    if posting is None:
+                        posting = postings[trigram] = array("I")
+                    posting.append(index)
+            self._indexed_counts[ignore_case] = chunk.stop
+            if time.monotonic() >= deadline:
+                break
+        return postings
+
+class ParallelSearch(object):
+
+    # Searches blocks in a pool of worker processes. The lines are copied
+    # once to shared memory so that only blocks of indices and matches need
+    # to be sent between processes. Small inputs are searched in-process.
+    # Blocks are searched the same way as without workers.
+
+    MIN_LINES = 100000
+
+    def __init__(self, workers=None):
+        self._workers = SearchWorkers() if workers is None else workers
+        self._slot = self._workers.allocate_slot()
+        self._search = MultiTermSearch()
+
+    def __call__(self, lines, expression, indices=None):
+        return self._search(lines, expression, indices)
+
+    def share(self):
+        # A search function that uses the same workers, but whose searches
+        # don't cancel the searches of this one.
+        return ParallelSearch(self._workers)
+
+    def map_blocks(self, lines, expression, blocks):
+        if (self._slot is None or
+                lines.is_loading() or
+                lines.count() < self.MIN_LINES or
+                (os.cpu_count() or 1) < 2):
+            return (
+                self._search(lines, expression, block)
+                for block
+                in blocks
+            )
+        return self._workers.map(lines, self._slot, expression, blocks)
+
+    def close(self):
+        if self._slot is not None:
+            self._workers.release_slot(self._slot)
+            self._slot = None
+
+class SearchWorkers(object):
+
+    # The pool of worker processes and the shared lines of parallel
+    # searches. Each search function has a slot with the generation of its
+    # latest search, and workers skip blocks queued for its earlier ones.
+    # The pool is closed when no search function uses it.
+
+    SLOTS = 64
+
+    def __init__(self):
+        self._pool = None
+        self._generations = None
+        self._shared_lines = None
+        self._free_slots = list(range(self.SLOTS))
+
+    def allocate_slot(self):
+        # Searches are done in-process when all slots are used.
+        if self._free_slots:
+            return self._free_slots.pop(0)
+
+    def release_slot(self, slot):
+        self._free_slots.append(slot)
+        if len(self._free_slots) == self.SLOTS:
+            self.close()
+
+    def map(self, lines, slot, expression, blocks):
+        shared_lines = self._get_shared_lines(lines)
+        pool = self._get_pool()
+        self._generations[slot] += 1
+        generation = self._generations[slot]
+        return pool.imap(_search_block, (
+            (shared_lines.name, slot, generation, expression, block)
+            for block
+            in blocks
+        ))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+        if self._shared_lines is not None:
+            self._shared_lines.unlink()
+            self._shared_lines = None
+
+    def _get_shared_lines(self, lines):
+        if (self._shared_lines is None or
+                self._shared_lines.count() != lines.count()):
+            if self._shared_lines is not None:
+                self._shared_lines.unlink()
+            self._shared_lines = SharedLines.create(lines)
+        return self._shared_lines
+
+    def _get_pool(self):
+        if self._pool is None:
+            import multiprocessing
+            self._generations = multiprocessing.RawArray("l", self.SLOTS)
+            self._pool = multiprocessing.Pool(
+                initializer=_init_search_worker,
+                initargs=(self._generations,)
+            )
+            atexit.register(self.close)
+        return self._pool
+
+_worker_generations = None
+_worker_shared_lines = {}
+_worker_search = MultiTermSearch()
+
+def _init_search_worker(generations):
+    global _worker_generations
+    _worker_generations = generations
+
+def _search_block(task):
+    name, slot, generation, expression, block = task
+    if _worker_generations[slot] != generation:
+        return []
+    if name not in _worker_shared_lines:
+        _worker_shared_lines.clear()
+        _worker_shared_lines[name] = SharedLines.attach(name)
+    return list(_worker_search(_worker_shared_lines[name], expression, block))
+
+class FuzzySearch(object):
+
+    # Matches lines that contain the characters of every positive term in
+    # order, but not necessarily next to each other. Only matched lines are
+    # scored, and only rendered ones are highlighted.
+
+    SCORE_MATCH = 16
+    SCORE_GAP_START = -5
+    SCORE_GAP_EXTENSION = -1
+    BONUS_BOUNDARY = 8
+    BONUS_SEPARATOR = 10
+    BONUS_CAMEL_CASE = 7
+    BONUS_CONSECUTIVE = 6
+    SEPARATORS = "/\\"
+    BOUNDARIES = " \t_-.:,;=()[]{}<>'\""
+
+    def __call__(self, lines, expression, indices=None):
+        if expression == expression.lower():
+            match = get_fuzzy_match_fn(
+                lines.fold_expression(expression),
+                folded=True
+            )
+            candidates = lines.iter_folded(indices)
+        else:
+            match = get_fuzzy_match_fn(expression)
+            candidates = lines.iter(indices)
+        return (index for (index, line) in candidates if match(line))
+
+    def score(self, lines, expression, indices):
+        if len(indices) > 0 and indices[-1] - indices[0] == len(indices) - 1:
+            # Lines in a range are decoded a block at a time.
+            indices = range(indices[0], indices[-1] + 1)
+        if expression == expression.lower():
+            _, terms, _ = split_terms(lines.fold_expression(expression))
+            candidates = zip(lines.iter_folded(indices), lines.iter(indices))
+        else:
+            _, terms, _ = split_terms(expression)
+            candidates = ((pair, pair) for pair in lines.iter(indices))
+        for ((_, line), (_, original)) in candidates:
+            if len(line) != len(original):
+                # Case can only be compared where positions are the same.
+                original = line
+            score = 0
+            for term in terms:
+                score += self._score_positions(
+                    line,
+                    original,
+                    find_fuzzy_positions(line, term)
+                )
+            yield score
+
+    def highlight(self, lines, expression, index):
+        if expression == expression.lower():
+            line = lines.get_folded(index)
+            _, terms, _ = split_terms(lines.fold_expression(expression))
+        else:
+            line = lines.get(index)
+            _, terms, _ = split_terms(expression)
+        ranges = merge_ranges(
+            (position, position+1)
+            for term
+            in terms
+            for position
+            in find_fuzzy_positions(line, term) or []
+        )
+        if expression == expression.lower():
+            return lines.map_folded_ranges(index, ranges)
+        else:
+            return ranges
+
+    def _score_positions(self, line, original, positions):
+        score = self.SCORE_MATCH * len(positions)
+        previous = None
+        for position in positions:
+            if previous is not None:
+                if position == previous + 1:
+                    score += self.BONUS_CONSECUTIVE
+                else:
+                    score += self.SCORE_GAP_START
+                    score += self.SCORE_GAP_EXTENSION * (position-previous-2)
+            if position == 0:
+                score += self.BONUS_BOUNDARY
+            elif line[position-1] in self.SEPARATORS:
+                score += self.BONUS_SEPARATOR
+            elif line[position-1] in self.BOUNDARIES:
+                score += self.BONUS_BOUNDARY
+            elif (original[position].isupper() and
+                    original[position-1].islower()):
+                score += self.BONUS_CAMEL_CASE
+            previous = position
+        return score
+
+def get_fuzzy_match_fn(expression, folded=False):
+    def match(line):
+        if ignore_case:
+            line = line.lower()
+        for pattern in patterns:
+            if pattern(line) is None:
+                return False
+        for term in negative:
+            if term[1:] in line and term not in line:
+                return False
+        return True
+    ignore_case, positive, negative = split_terms(expression)
+    ignore_case = ignore_case and not folded
+    # Anchored patterns like [^a]*a[^b]*b only try one way of matching.
+    patterns = [
+        re.compile("".join(
+            "[^{0}]*{0}".format(re.escape(character))
+            for character
+            in term
+        ), re.DOTALL).match
+        for term
+        in positive
+    ]
+    return match
+
+def find_fuzzy_positions(line, term):
+    # The first match is found going forwards. Going backwards from its end
+    # then gives the shortest match ending there.
+    end = -1
+    for character in term:
+        end = line.find(character, end + 1)
+        if end == -1:
+            return None
+    positions = []
+    start = end + 1
+    for character in reversed(term):
+        start = line.rfind(character, 0, start)
+        positions.append(start)
+    positions.reverse()
+    return positions
+
 CTRL_W = u"\u0017"
 CTRL_N = u"\u000E"
 CTRL_P = u"\u0010"
+CTRL_F = u"\u0006"
+CTRL_B = u"\u0002"
 CTRL_C = u"\u0003"
 CTRL_G = u"\u0007"
 ESC = u"\u001B"
@@ -154,6 +926,9 @@ CR = u"\u000D"
 LF = u"\u000A"
 TAB = u"\u0009"
 
+POLL_INTERVAL_MS = 100
+SEARCH_SLICE_SECONDS = 0.02
+
 def is_printable(unicode_character):
     return ord(unicode_character) >= 32
 
@@ -164,14 +939,186 @@ ACTION_ESC = Action(True, "esc")
 ACTION_CTRL_C = Action(True, "ctrl-c")
 ACTION_CTRL_G = Action(True, "ctrl-g")
 
+Candidates = namedtuple("Candidates", ["indices", "tail_start"])
+
+ALL_CANDIDATES = Candidates([], 0)
+
+def iter_candidate_blocks(candidates, end, block_size):
+    for start in range(0, len(candidates.indices), block_size):
+        yield candidates.indices[start:start+block_size]
+    for start in range(candidates.tail_start, end, block_size):
+        yield range(start, min(start+block_size, end))
+
+class SearchResult(object):
+
+    # Searching is done in blocks of candidates so that a fetch can give up
+    # at a deadline even if no lines match.
+    BLOCK_SIZE = 10000
+
+    def __init__(self, lines, term, search_fn, candidates=ALL_CANDIDATES):
+        self._lines = lines
+        self._term = term
+        self._search_fn = search_fn
+        self._candidates = candidates
+        self._end = lines.count()
+        self.scanned = 0
+        self._block_results = self._search_blocks(iter_candidate_blocks(
+            candidates, self._end, self.BLOCK_SIZE
+        ))
+        self._generator = None
+        self._matches = []
+        self._exhausted = False
+
+    def is_complete(self, count=None):
+        # Lines that arrive later are only searched if more matches are
+        # needed.
+        if count is not None and len(self._matches) >= count:
+            return True
+        return self._exhausted and self._lines.count() <= self._end
+
+    def fetch(self, count=None, deadline=None):
+        while not self.is_complete(count):
+            if self._generator is None:
+                block_result = next(self._block_results, None)
+                if block_result is None:
+                    self._exhausted = not self._search_new_lines()
+                    if self._exhausted:
+                        break
+                    continue
+                self._generator = iter(block_result)
+            if count is None:
+                self._matches.extend(self._generator)
+                self._generator = None
+            else:
+                needed = count - len(self._matches)
+                fetched = list(islice(self._generator, needed))
+                self._matches.extend(fetched)
+                if len(fetched) < needed:
+                    self._generator = None
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+        return self._matches[:count]
+
+    def _search_new_lines(self):
+        # Lines that arrived after the search was started. Only the new ones
+        # need to be searched.
+        if self._lines.count() <= self._end:
+            return False
+        self._block_results = self._search_blocks(iter_candidate_blocks(
+            Candidates([], self._end),
+            self._lines.count(),
+            self.BLOCK_SIZE
+        ))
+        self._end = self._lines.count()
+        return True
+
+    def _search_blocks(self, blocks):
+        blocks = self._count_scanned(blocks)
+        map_blocks = getattr(self._search_fn, "map_blocks", None)
+        if map_blocks is not None:
+            return map_blocks(self._lines, self._term, blocks)
+        else:
+            return (
+                self._search_fn(self._lines, self._term, block)
+                for block
+                in blocks
+            )
+
+    def _count_scanned(self, blocks):
+        for block in blocks:
+            self.scanned += len(block)
+            yield block
+
+    def size(self):
+        return len(self._matches) + len(self._candidates.indices)
+
+    def resume(self):
+        # Blocks of an unfinished search might have been given up on while
+        # other terms were searched, so it continues with a fresh cursor.
+        if self._exhausted:
+            return self
+        return SearchResult(
+            self._lines,
+            self._term,
+            self._search_fn,
+            self._remaining_candidates()
+        )
+
+    def refine(self, term):
+        if is_refinement(self._term, term):
+            return SearchResult(
+                self._lines,
+                term,
+                self._search_fn,
+                self._remaining_candidates()
+            )
+
+    def _remaining_candidates(self):
+        matched = list(self._matches)
+        if self._exhausted:
+            return Candidates(matched, self._end)
+        if not matched:
+            return self._candidates
+        last = matched[-1]
+        return Candidates(
+            matched + [
+                index
+                for index
+                in self._candidates.indices
+                if index > last
+            ],
+            max(self._candidates.tail_start, last + 1)
+        )
+
+class TopMatches(object):
+
+    # Keeps the best scored matches in a bounded heap. Matches are only
+    # scored once, a block at a time, and never sorted as a whole.
+
+    BLOCK_SIZE = 1000
+
+    def __init__(self, score_fn, count):
+        self.count = count
+        self._score_fn = score_fn
+        self._heap = []
+        self._scored = 0
+        self._complete = True
+
+    def is_complete(self):
+        return self._complete
+
+    def update(self, matches, deadline=None):
+        while self._scored < len(matches):
+            new_matches = matches[self._scored:self._scored+self.BLOCK_SIZE]
+            for index, score in zip(new_matches, self._score_fn(new_matches)):
+                # Ties go to the line that came first.
+                item = (score, -index)
+                if len(self._heap) < self.count:
+                    heapq.heappush(self._heap, item)
+                elif self.count > 0 and item > self._heap[0]:
+                    heapq.heapreplace(self._heap, item)
+            self._scored += len(new_matches)
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+        self._complete = self._scored == len(matches)
+        return [-index for (_, index) in sorted(self._heap, reverse=True)]
+
 class UiController(object):
 
     MATCHES_START_LINE = 2
+    # Cached searches are evicted, least recently used first, when they
+    # hold more line indices than this.
+    RESULT_CACHE_SIZE = 1000000
 
     def __init__(self, lines, term, search_fn, tab_exits, extended_status_line):
         self._lines = lines
         self._term = term
         self._search_fn = search_fn
+        self._highlight_fn = getattr(search_fn, "highlight", highlight)
+        self._score_fn = getattr(search_fn, "score", None)
+        self._highlights = {}
+        self._views = {}
+        self._top_matches = None
         self._action_map = {
             CR: ACTION_ENTER,
             LF: ACTION_ENTER,
@@ -183,77 +1130,195 @@ class UiController(object):
             self._action_map[TAB] = ACTION_TAB
         self._extended_status_line = extended_status_line
         self._total_nbr_of_matched_lines = 0
+        self._scroll = 0
+        self._wanted_matches = 0
+        self._result = None
+        self._results = OrderedDict()
+        self._searched_lines_count = 0
 
     def setup(self, screen):
         self._read_size(screen)
         self._set_term(self._term)
 
+    def resize(self, screen):
+        # Matches already found are reused for the new size.
+        self._read_size(screen)
+        self._fetch_matches(self._get_search_deadline())
+        if self._match_highlight >= len(self._matches):
+            self._match_highlight = len(self._matches) - 1
+        self._scroll_to_highlight()
+
+    def is_busy(self):
+        return (
+            self._lines.is_loading() or
+            self._lines.count() != self._searched_lines_count or
+            self.is_searching()
+        )
+
+    def is_searching(self):
+        if self._score_fn is not None:
+            return not (
+                self._result.is_complete() and
+                self._top_matches.is_complete()
+            )
+        elif self._extended_status_line:
+            return not self._result.is_complete()
+        else:
+            return not self._result.is_complete(self._get_wanted_matches())
+
+    def update(self):
+        if not self.is_busy():
+            return False
+        with STATS.time("update", term=self._term) as fields:
+            self._fetch_matches(self._get_search_deadline())
+            self._add_search_stats(fields)
+        if self._match_highlight == -1 and len(self._matches) > 0:
+            self._match_highlight = 0
+        return True
+
     def render(self, screen):
-        screen.erase()
-        self._render_matches(screen)
-        self._render_header(screen)
-        self._render_term(screen)
-        screen.refresh()
+        with STATS.time("render", matches=len(self._matches)):
+            screen.erase()
+            self._render_matches(screen)
+            self._render_header(screen)
+            self._render_term(screen)
+            screen.refresh()
 
     def process_input(self, unicode_character):
-        if unicode_character == BS:
-            self._set_term(self._term[:-1])
-        elif unicode_character == CTRL_W:
-            self._set_term(strip_last_word(self._term))
-        elif unicode_character == CTRL_N:
+        return self.process_inputs(unicode_character)
+
+    def process_inputs(self, unicode_characters):
+        # Edits of the term are applied together, so that typed ahead or
+        # pasted characters are only searched for once.
+        new_term = None
+        for unicode_character in unicode_characters:
+            term = self._term if new_term is None else new_term
+            if unicode_character == BS:
+                new_term = term[:-1]
+            elif unicode_character == CTRL_W:
+                new_term = strip_last_word(term)
+            elif is_printable(unicode_character):
+                new_term = term + unicode_character
+            else:
+                if new_term is not None:
+                    self._set_term(new_term)
+                    new_term = None
+                result = self._process_key(unicode_character)
+                if result:
+                    return result
+        if new_term is not None:
+            self._set_term(new_term)
+
+    def _process_key(self, unicode_character):
+        if unicode_character == CTRL_N:
             self._set_match_highlight(self._match_highlight + 1)
         elif unicode_character == CTRL_P:
             self._set_match_highlight(self._match_highlight - 1)
+        elif unicode_character == CTRL_F:
+            self._move_page(1)
+        elif unicode_character == CTRL_B:
+            self._move_page(-1)
         elif unicode_character in self._action_map:
             return (
                 self._action_map[unicode_character],
                 self._get_selected_item()
             )
-        elif is_printable(unicode_character):
-            self._set_term(self._term + unicode_character)
 
     def _read_size(self, screen):
         y, x = screen.getmaxyx()
         self._height = y
         self._width = x
+        self._views = {}
 
     def _render_matches(self, screen):
         y = self.MATCHES_START_LINE
-        for (match_index, (line_index, items)) in enumerate(self._matches):
-            self._render_match(
-                screen, y, match_index, self._lines.get(line_index), items
-            )
+        for (match_index, line_index) in self._get_visible_matches():
+            self._render_match(screen, y, match_index, line_index)
             y += 1
 
-    def _render_match(self, screen, y, match_index, line, items):
+    def _get_visible_matches(self):
+        end = min(len(self._matches), self._scroll + self._max_matches())
+        return [
+            (match_index, self._matches[match_index])
+            for match_index
+            in range(self._scroll, end)
+        ]
+
+    def _render_match(self, screen, y, match_index, line_index):
+        view = self._get_view(line_index)
         if match_index == self._match_highlight:
-            self._text(screen, y, 0, self._get_line_text(line), "select")
+            self._text(screen, y, 0, view.text.ljust(self._width), "select")
         else:
-            last = 0
+            if view.segments is None:
+                view.segments = [
+                    (view.text[start-view.start:end-view.start], style)
+                    for (start, end, style)
+                    in self._get_styled_ranges(
+                        line_index,
+                        view.start,
+                        view.start + len(view.text)
+                    )
+                ]
             x = 0
-            for start, end in items:
-                x += self._text(screen, y, x, line[last:start], "default")
-                x += self._text(screen, y, x, line[start:end], "highlight")
-                last = end
-            self._text(screen, y, x, line[last:], "default")
-
-    def _get_line_text(self, line):
-        return line.ljust(self._width)
+            for text, style in view.segments:
+                x += self._text(screen, y, x, text, style)
+
+    def _get_view(self, line_index):
+        # Only the part of a line that fits on the screen is rendered, and it
+        # is kept until the term or the width changes.
+        if line_index not in self._views:
+            line = self._lines.get(line_index)
+            start, end = 0, find_display_end(line, 0, self._width)
+            if end < len(line):
+                start, end = get_display_window(
+                    line,
+                    next(iter(self._get_highlights(line_index)), None),
+                    self._width
+                )
+            self._views[line_index] = LineView(start, line[start:end])
+        return self._views[line_index]
+
+    def _get_styled_ranges(self, line_index, start, end):
+        # Highlights are drawn over the colours of the line.
+        colors = self._lines.get_colors(line_index)
+        last = start
+        for highlight_start, highlight_end in self._get_highlights(line_index):
+            if highlight_end <= start:
+                continue
+            if highlight_start >= end:
+                break
+            yield from split_color_ranges(last, highlight_start, colors)
+            yield (max(last, highlight_start), min(end, highlight_end), "highlight")
+            last = min(end, highlight_end)
+        yield from split_color_ranges(last, end, colors)
+
+    def _get_highlights(self, line_index):
+        # Highlights are only computed for rendered matches.
+        if line_index not in self._highlights:
+            self._highlights[line_index] = self._highlight_fn(
+                self._lines, self._term, line_index
+            )
+        return self._highlights[line_index]
 
     def _render_header(self, screen):
         self._text(screen, 1, 0, self._get_status_text(), "status")
 
     def _get_status_text(self):
         if self._extended_status_line:
-            return u"{} lines matched, {} lines visible, among {:,} lines ".format(
+            text = u"{} lines matched, {} lines visible, among {:,} lines".format(
                 self._total_nbr_of_matched_lines,
-                len(self._matches),
-                self._lines.count()
-            ).rjust(self._width)
+                len(self._get_visible_matches()),
+                self._searched_lines_count
+            )
         else:
-            return u"selectiong among {:,} lines ".format(
-                self._lines.count()
-            ).rjust(self._width)
+            text = u"selectiong among {:,} lines".format(
+                self._searched_lines_count
+            )
+        if self._lines.is_loading():
+            text += u" (reading)"
+        elif self.is_searching():
+            text += u" (searching)"
+        return (text + u" ").rjust(self._width)
 
     def _render_term(self, screen):
         self._text(screen, 0, 0, self._get_term_text(), "default")
@@ -264,58 +1329,243 @@ class UiController(object):
     def _text(self, screen, y, x, text, style):
         if x >= self._width:
             return 0
-        text = expand_variable_width(text)
-        if x + len(text) >= self._width:
-            text = text[:self._width-x]
-        screen.addstr(y, x, text, style)
-        return len(text)
+        text, width = fit_display_width(text, self._width - x)
+        screen.addstr(y, x, expand_variable_width(text), style)
+        return width
 
     def _set_term(self, new_term):
-        self._term = new_term
-        if self._extended_status_line:
-            self._search_extended()
-        else:
-            self._search()
-        if len(self._matches) > 0:
-            self._match_highlight = 0
+        with STATS.time("search", term=new_term) as fields:
+            self._cache_result()
+            self._term = new_term
+            self._views = {}
+            fields["cached"] = new_term in self._results
+            if new_term in self._results:
+                (result, self._top_matches, self._highlights) = (
+                    self._results.pop(new_term)
+                )
+                self._result = result.resume()
+            else:
+                self._top_matches = None
+                self._highlights = {}
+                self._result = self._create_search_result()
+            self._scroll = 0
+            self._wanted_matches = 0
+            self._fetch_matches(self._get_search_deadline())
+            if len(self._matches) > 0:
+                self._match_highlight = 0
+            else:
+                self._match_highlight = -1
+            self._add_search_stats(fields)
+
+    def _add_search_stats(self, fields):
+        fields["lines"] = self._searched_lines_count
+        fields["scanned"] = self._result.scanned
+        fields["matches"] = len(self._matches)
+        fields["complete"] = not self.is_searching()
+
+    def _fetch_matches(self, deadline=None):
+        # Matches are only fetched down to the last one scrolled to. The
+        # search result continues where it stopped when more are needed.
+        self._searched_lines_count = self._lines.count()
+        if self._score_fn is not None:
+            # All lines must be searched to know which matches are best.
+            all_matches = self._result.fetch(None, deadline)
+            self._total_nbr_of_matched_lines = len(all_matches)
+            self._matches = self._get_top_matches().update(
+                all_matches,
+                deadline
+            )
+        elif self._extended_status_line:
+            all_matches = self._result.fetch(None, deadline)
+            self._total_nbr_of_matched_lines = len(all_matches)
+            self._matches = all_matches[: self._get_wanted_matches()]
         else:
-            self._match_highlight = -1
+            self._matches = self._result.fetch(
+                self._get_wanted_matches(),
+                deadline
+            )
+            self._total_nbr_of_matched_lines = len(self._matches)
 
-    def _search(self):
-        self._matches = list(islice(
-            self._search_fn(self._lines, self._term),
-            self._max_matches()
-        ))
+    def _get_wanted_matches(self):
+        return max(self._wanted_matches, self._scroll + self._max_matches())
+
+    def _has_more_matches(self):
+        return (
+            not self._result.is_complete() or
+            self._total_nbr_of_matched_lines > len(self._matches)
+        )
 
-    def _search_extended(self):
-        all_matches = list(self._search_fn(self._lines, self._term))
-        self._total_nbr_of_matched_lines = len(all_matches)
-        self._matches = all_matches[: self._max_matches()]
+    def _get_search_deadline(self):
+        return time.monotonic() + SEARCH_SLICE_SECONDS
+
+    def _cache_result(self):
+        if self._result is None:
+            return
+        self._results[self._term] = (
+            self._result,
+            self._top_matches,
+            self._highlights
+        )
+        size = sum(
+            max(1, result.size())
+            for (result, _, _)
+            in self._results.values()
+        )
+        while size > self.RESULT_CACHE_SIZE and len(self._results) > 1:
+            (result, _, _) = self._results.popitem(last=False)[1]
+            size -= max(1, result.size())
+
+    def _create_search_result(self):
+        # The longest cached term that the new term refines is most likely
+        # the one with the fewest matches to search again.
+        for term in sorted(self._results, key=len, reverse=True):
+            result = self._results[term][0].refine(self._term)
+            if result is not None:
+                return result
+        return SearchResult(self._lines, self._term, self._search_fn)
+
+    def _get_top_matches(self):
+        count = self._get_wanted_matches()
+        if self._top_matches is None or self._top_matches.count < count:
+            if self._top_matches is not None:
+                # All matches are scored again for a longer list of best
+                # matches, so it grows at least twice as long.
+                count = max(count, 2*self._top_matches.count)
+            self._top_matches = TopMatches(
+                lambda indices: self._score_fn(self._lines, self._term, indices),
+                count
+            )
+        return self._top_matches
 
     def _max_matches(self):
         return max(0, self._height - self.MATCHES_START_LINE)
 
-    def _set_match_highlight(self, new_value):
+    def _set_match_highlight(self, new_value, wrap=True):
+        if new_value >= len(self._matches) and self._has_more_matches():
+            self._wanted_matches = new_value + 1
+            self._fetch_matches(self._get_search_deadline())
         if len(self._matches) == 0:
             return
         if new_value >= len(self._matches):
-            self._match_highlight = 0
+            if wrap and not self._has_more_matches():
+                self._match_highlight = 0
+            else:
+                # The search might not have found more matches yet.
+                self._match_highlight = len(self._matches) - 1
         elif new_value < 0:
-            self._match_highlight = len(self._matches) - 1
+            self._match_highlight = len(self._matches) - 1 if wrap else 0
         else:
             self._match_highlight = new_value
+        self._scroll_to_highlight()
+
+    def _move_page(self, direction):
+        offset = self._match_highlight - self._scroll
+        self._set_match_highlight(
+            self._match_highlight + direction*self._max_matches(),
+            wrap=False
+        )
+        self._scroll = max(0, self._match_highlight - offset)
+        if (len(self._matches) < self._get_wanted_matches() and
+                self._has_more_matches()):
+            # Only matches down to the highlight were fetched before the
+            # view was scrolled.
+            self._fetch_matches(self._get_search_deadline())
+
+    def _scroll_to_highlight(self):
+        if self._match_highlight < self._scroll:
+            self._scroll = max(0, self._match_highlight)
+        elif self._match_highlight >= self._scroll + self._max_matches():
+            self._scroll = self._match_highlight - self._max_matches() + 1
 
     def _get_selected_item(self):
         if self._match_highlight != -1:
-            return self._lines.get(self._matches[self._match_highlight][0])
-        elif len(self._matches) > 0:
-            return self._lines.get(self._matches[0][0])
+            return self._lines.get(self._matches[self._match_highlight])
+        # The search might not have found the first match yet.
+        matches = self._result.fetch(1)
+        if len(matches) > 0:
+            return self._lines.get(matches[0])
         else:
             return self._term
 
+def split_color_ranges(start, end, colors):
+    for (color_start, color_end, style) in colors:
+        if color_end <= start or color_start >= end:
+            continue
+        if color_start > start:
+            yield (start, color_start, "default")
+        yield (max(start, color_start), min(end, color_end), style)
+        start = min(end, color_end)
+    if start < end:
+        yield (start, end, "default")
+
 def expand_variable_width(text):
     return text.replace("\t", "    ")
 
+class LineView(object):
+
+    def __init__(self, start, text):
+        self.start = start
+        self.text = text
+        self.segments = None
+
+def get_display_window(line, highlight, width):
+    # The start and end of the characters of a line that fit in width
+    # columns. Lines are shown from the start, unless the highlight would
+    # not be visible. Then the window is centred on it.
+    end = find_display_end(line, 0, width)
+    if highlight is None or highlight[1] <= end:
+        return (0, end)
+    start = find_display_start(line, highlight[0], width // 2)
+    return (start, find_display_end(line, start, width))
+
+def find_display_end(line, start, width):
+    if is_narrow(line[start:start+width+1]):
+        return min(len(line), start + width)
+    while start < len(line):
+        width -= get_character_width(line[start])
+        if width < 0:
+            break
+        start += 1
+    return start
+
+def find_display_start(line, end, width):
+    if is_narrow(line[max(0, end-width-1):end]):
+        return max(0, end - width)
+    while end > 0:
+        width -= get_character_width(line[end-1])
+        if width < 0:
+            break
+        end -= 1
+    return end
+
+def fit_display_width(text, width):
+    # The start of the text that fits in width columns, and the number of
+    # columns it takes.
+    if width <= 0:
+        return ("", 0)
+    if is_narrow(text):
+        text = text[:width]
+        return (text, len(text))
+    text = text[:find_display_end(text, 0, width)]
+    return (text, sum(get_character_width(character) for character in text))
+
+def is_narrow(text):
+    # Most lines only have characters that take one column each.
+    return text.isascii() and "\t" not in text
+
+def get_character_width(character):
+    if character not in CHARACTER_WIDTHS:
+        import unicodedata
+        if unicodedata.combining(character):
+            CHARACTER_WIDTHS[character] = 0
+        elif unicodedata.east_asian_width(character) in ("W", "F"):
+            CHARACTER_WIDTHS[character] = 2
+        else:
+            CHARACTER_WIDTHS[character] = 1
+    return CHARACTER_WIDTHS[character]
+
+CHARACTER_WIDTHS = {"\t": len(expand_variable_width("\t"))}
+
 def strip_last_word(text):
     remaining_parts = text.rstrip().split(" ")[:-1]
     if remaining_parts:
@@ -323,62 +1573,1242 @@ def strip_last_word(text):
     else:
         return ""
 
+# Control sequences (CSI), operating system commands (OSC) and other escape
+# sequences. Only select graphic rendition (SGR) sequences, CSI ending with
+# m, change colours.
+ANSI_ESCAPE_PATTERN = (
+    r"\x1b(?:"
+    r"\[([0-?]*)[ -/]*([@-~])|"
+    r"\][^\x07\x1b]*(?:\x07|\x1b\\)?|"
+    r"[ -/]*[0-~]"
+    r")"
+)
+
+AnsiState = namedtuple("AnsiState", ["fg", "bg", "bold", "underline", "reverse"])
+
+DEFAULT_ANSI_STATE = AnsiState(None, None, False, False, False)
+
+class AnsiParser(object):
+
+    # Removes escape sequences from lines as they are read, in one pass
+    # over each chunk. Colours set by SGR sequences are kept as spans of
+    # (start, end, style) in the remaining text. Like in a terminal,
+    # colours carry over to the following lines until they are reset.
+
+    def __init__(self):
+        self._split_escapes = re.compile(ANSI_ESCAPE_PATTERN).split
+        self._style = None
+        self._transitions = {}
+
+    def split(self, data):
+        lines = data.splitlines()
+        colors = {}
+        if "\x1b" not in data and self._style is None:
+            return (lines, colors)
+        for (index, line) in enumerate(lines):
+            if "\x1b" in line:
+                (lines[index], spans) = self.parse(line)
+            elif self._style is not None and line:
+                spans = ((0, len(line), self._style),)
+            else:
+                continue
+            if spans:
+                colors[index] = spans
+        return (lines, colors)
+
+    def parse(self, line):
+        # Split gives the text before every escape sequence, followed by
+        # the parameters and final character of it, and the text after the
+        # last one.
+        pieces = self._split_escapes(line)
+        transitions = self._transitions
+        style = self._style
+        spans = []
+        position = len(pieces[0])
+        if position > 0 and style is not None:
+            spans.append((0, position, style))
+        for index in range(1, len(pieces), 3):
+            if pieces[index+1] == "m":
+                key = (style, pieces[index])
+                if key in transitions:
+                    style = transitions[key]
+                else:
+                    style = self._add_transition(key)
+            length = len(pieces[index+2])
+            if length > 0 and style is not None:
+                spans.append((position, position + length, style))
+            position += length
+        self._style = style
+        return ("".join(pieces[::3]), tuple(spans))
+
+    def parse_alone(self, line):
+        # Colours of earlier lines don't carry over to this one.
+        self._style = None
+        return self.parse(line)
+
+    def _add_transition(self, key):
+        # The few different sequences are only parsed once. The style
+        # string is the state, and spans share one string per state.
+        (style, parameters) = key
+        state = apply_sgr(
+            DEFAULT_ANSI_STATE if style is None else parse_ansi_style(style),
+            parameters
+        )
+        if state == DEFAULT_ANSI_STATE:
+            self._transitions[key] = None
+        else:
+            self._transitions[key] = sys.intern(format_ansi_style(state))
+        return self._transitions[key]
+
+def apply_sgr(state, parameters):
+    codes = parameters.split(";")
+    index = 0
+    while index < len(codes):
+        code = codes[index]
+        index += 1
+        if ":" in code:
+            # Sub-parameters, like 38:2::255:128:0.
+            (code, arguments) = (code.split(":")[0], code.split(":")[1:])
+        else:
+            arguments = None
+        code = int(code) if code.isdigit() else 0
+        if code == 0:
+            state = DEFAULT_ANSI_STATE
+        elif code == 1:
+            state = state._replace(bold=True)
+        elif code == 22:
+            state = state._replace(bold=False)
+        elif code == 4:
+            state = state._replace(underline=True)
+        elif code == 24:
+            state = state._replace(underline=False)
+        elif code == 7:
+            state = state._replace(reverse=True)
+        elif code == 27:
+            state = state._replace(reverse=False)
+        elif 30 <= code <= 37:
+            state = state._replace(fg=code - 30)
+        elif 40 <= code <= 47:
+            state = state._replace(bg=code - 40)
+        elif 90 <= code <= 97:
+            state = state._replace(fg=code - 90 + 8)
+        elif 100 <= code <= 107:
+            state = state._replace(bg=code - 100 + 8)
+        elif code == 39:
+            state = state._replace(fg=None)
+        elif code == 49:
+            state = state._replace(bg=None)
+        elif code in (38, 48):
+            if arguments is None:
+                arguments = codes[index:index+4]
+                index += 2 if arguments[:1] == ["5"] else 4
+            elif arguments[:1] == ["2"] and len(arguments) > 4:
+                # The colour space is left out.
+                arguments = ["2"] + arguments[-3:]
+            color = parse_extended_color(arguments)
+            if code == 38:
+                state = state._replace(fg=color)
+            else:
+                state = state._replace(bg=color)
+    return state
+
+def parse_extended_color(arguments):
+    try:
+        if arguments[0] == "5":
+            return min(int(arguments[1]), 255)
+        elif arguments[0] == "2" and len(arguments) >= 4:
+            return tuple(min(int(value or 0), 255) for value in arguments[1:4])
+    except (IndexError, ValueError):
+        pass
+    return None
+
+def format_ansi_style(state):
+    # A style name that the UIs turn into colours.
+    def color(value):
+        if value is None:
+            return ""
+        elif isinstance(value, tuple):
+            return "#{:02x}{:02x}{:02x}".format(*value)
+        else:
+            return str(value)
+    return "ansi:{}:{}:{}{}{}".format(
+        color(state.fg),
+        color(state.bg),
+        "b" if state.bold else "",
+        "u" if state.underline else "",
+        "r" if state.reverse else ""
+    )
+
+def parse_ansi_style(style):
+    def color(value):
+        if value.startswith("#"):
+            return tuple(int(value[i:i+2], 16) for i in (1, 3, 5))
+        elif value:
+            return int(value)
+        else:
+            return None
+    (_, fg, bg, flags) = style.split(":")
+    return AnsiState(color(fg), color(bg), "b" in flags, "u" in flags, "r" in flags)
+
+def get_ansi_rgb(color):
+    # Colours of the xterm palette, or a truecolour.
+    if isinstance(color, tuple):
+        return color
+    elif color < 16:
+        return ANSI_BASE_COLORS[color]
+    elif color < 232:
+        levels = (0, 95, 135, 175, 215, 255)
+        color -= 16
+        return (levels[color // 36], levels[color // 6 % 6], levels[color % 6])
+    else:
+        gray = 8 + (color - 232) * 10
+        return (gray, gray, gray)
+
+def get_ansi_color_index(color, count):
+    # The closest of the first count palette colours, for terminals that
+    # have fewer colours.
+    if not isinstance(color, tuple) and color < count:
+        return color
+    (r, g, b) = get_ansi_rgb(color)
+    return min(range(min(count, 256)), key=lambda index: sum(
+        (x - y) ** 2
+        for (x, y)
+        in zip((r, g, b), get_ansi_rgb(index))
+    ))
+
+ANSI_BASE_COLORS = (
+    (0, 0, 0), (205, 0, 0), (0, 205, 0), (205, 205, 0),
+    (0, 0, 238), (205, 0, 205), (0, 205, 205), (229, 229, 229),
+    (127, 127, 127), (255, 0, 0), (0, 255, 0), (255, 255, 0),
+    (92, 92, 255), (255, 0, 255), (0, 255, 255), (255, 255, 255),
+)
+
 class Lines(object):
 
     @staticmethod
     def from_stream(stream, no_ansi_esc=False):
         if platform_is_windows():
-            data = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8').read()
-        else:
-            data = stream.read()
-        if no_ansi_esc:
-            data = Lines.remove_ansi_sequencies(data)
-        return Lines(data.splitlines())
+            stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+        lines = Lines([])
+        lines.read_stream(stream, no_ansi_esc)
+        return lines
 
     @staticmethod
-    def remove_ansi_sequencies(data):
-        ansi_sequences_to_remove = (
-            "\x1b[0m",  # End mark
-            "\x1b[30m", # Color black
-            "\x1b[31m", # Color red
-            "\x1b[32m", # Color green
-            "\x1b[33m", # Color yellow
-            "\x1b[34m", # Color blue
-            "\x1b[35m", # Color magenta
-            "\x1b[36m", # Color cyan
-            "\x1b[37m", # Color white
+    def from_stream_in_background(stream, no_ansi_esc=False):
+        lines = Lines([])
+        lines._loading = True
+        thread = threading.Thread(
+            target=lines.read_stream,
+            args=(stream, no_ansi_esc),
+            daemon=True
         )
-        for ansi_sequence in ansi_sequences_to_remove:
-            data = data.replace(ansi_sequence, '')
-        return data
+        thread.start()
+        return lines
+
+    # Lines are stored utf-8 encoded, each followed by a newline, in one
+    # buffer with an offset table. Duplicates are found with an open
+    # addressing table of line indices and the hash of every line, so no
+    # line is kept as a str object.
+
+    ENCODING = ("utf-8", "surrogatepass")
+    ITER_BLOCK_SIZE = 10000
 
     def __init__(self, lines):
-        self._lines = unique(lines)
+        self._text = bytearray()
+        self._offsets = array("Q", [0])
+        self._hashes = array("q")
+        self._slots = array("q", [-1]) * 8
+        self._split_safe = True
+        self._loading = False
+        self._folder = Folder()
+        self._folded = None
+        self._colors = {}
+        self._add_lines(lines)
+
+    def read_stream(self, stream, no_ansi_esc=False):
+        try:
+            for (lines, colors) in read_line_batches(stream, no_ansi_esc):
+                with STATS.time("dedup", lines=len(lines)) as fields:
+                    count = self.count()
+                    self._add_lines(lines, colors)
+                    fields["new_lines"] = self.count() - count
+        finally:
+            self._loading = False
+
+    def _add_lines(self, lines, colors=None):
+        first_new_index = self.count()
+        new_lines = self._find_new(dict.fromkeys(lines))
+        if new_lines:
+            self._append_text(new_lines)
+        if colors:
+            # Equal lines keep the colours of the first one.
+            positions = {}
+            for (position, line) in enumerate(lines):
+                positions.setdefault(line, position)
+            for (index, line) in enumerate(new_lines, first_new_index):
+                if positions[line] in colors:
+                    self._colors[index] = colors[positions[line]]
+
+    def _find_new(self, batch):
+        if len(self._hashes) < self.count():
+            self._hash_lines()
+        # The batch has no duplicates, so only keys of lines stored earlier
+        # need to be compared.
+        hashes = self._hashes
+        first_new_index = count = len(hashes)
+        self._reserve_slots(first_new_index + len(batch))
+        slots = self._slots
+        mask = len(slots) - 1
+        new_keys = []
+        for key in batch:
+            key_hash = hash(key)
+            slot = key_hash & mask
+            index = slots[slot]
+            while index != -1:
+                if (index < first_new_index and
+                        hashes[index] == key_hash and
+                        self._get_key(index) == key):
+                    break
+                slot = (slot + 1) & mask
+                index = slots[slot]
+            else:
+                slots[slot] = count
+                count += 1
+                new_keys.append(key)
+        # Str and bytes objects cache their hash, so this does not rehash.
+        hashes.extend(map(hash, new_keys))
+        return new_keys
+
+    def _get_key(self, index):
+        return self.get(index)
+
+    def _hash_lines(self):
+        # Lines copied without hashing are hashed once lines are added.
+        self._hashes.extend(
+            hash(self._get_key(index))
+            for index
+            in range(len(self._hashes), self.count())
+        )
+        self._reserve_slots(self.count(), rebuild=True)
+
+    def _reserve_slots(self, count, rebuild=False):
+        size = len(self._slots)
+        if size >= count * 2 and not rebuild:
+            return
+        while size < count * 2:
+            size *= 2
+        slots = array("q", [-1]) * size
+        mask = size - 1
+        for index, line_hash in enumerate(self._hashes):
+            slot = line_hash & mask
+            while slots[slot] != -1:
+                slot = (slot + 1) & mask
+            slots[slot] = index
+        self._slots = slots
+
+    def _append_text(self, new_lines):
+        data = "\n".join(new_lines) + "\n"
+        if data.count("\n") != len(new_lines):
+            self._split_safe = False
+        if data.isascii():
+            lengths = map(len, new_lines)
+        else:
+            lengths = (len(line.encode(*self.ENCODING)) for line in new_lines)
+        start = len(self._text)
+        self._text += data.encode(*self.ENCODING)
+        # Offsets are added last since they define the count. Every line is
+        # followed by a newline.
+        self._offsets.extend(map(
+            operator.add,
+            accumulate(lengths),
+            range(start + 1, start + 1 + len(new_lines))
+        ))
 
+    def snapshot(self):
+        return (bytes(self._text), self._offsets.tobytes(), self._split_safe)
 
-    def iter(self):
-        return enumerate(self._lines)
+    @staticmethod
+    def from_snapshot(snapshot, skipped=()):
+        # Lines of a snapshot are known to be unique, so they are copied as
+        # encoded text without being hashed.
+        (text, offsets, split_safe) = snapshot
+        lines = Lines([])
+        lines._append_snapshot(text, offsets, split_safe, skipped)
+        return lines
+
+    def _append_snapshot(self, text, offsets, split_safe, skipped=()):
+        snapshot_offsets = array("Q")
+        snapshot_offsets.frombytes(offsets)
+        start = 0
+        for stop in sorted(skipped) + [len(snapshot_offsets) - 1]:
+            if stop > start:
+                shift = len(self._text) - snapshot_offsets[start]
+                self._text += text[
+                    snapshot_offsets[start]:snapshot_offsets[stop]
+                ]
+                self._offsets.extend(map(
+                    operator.add,
+                    snapshot_offsets[start+1:stop+1],
+                    repeat(shift)
+                ))
+            start = stop + 1
+        self._split_safe = self._split_safe and split_safe
+
+    def is_loading(self):
+        return self._loading
+
+    def set_fold_mode(self, mode):
+        self._folder = Folder(mode)
+        self._folded = None
+
+    def fold_expression(self, expression):
+        return self._folder.fold_expression(expression)
+
+    def iter_folded(self, indices=None):
+        if indices is None:
+            indices = range(self.count())
+        elif not isinstance(indices, range):
+            indices = list(indices)
+        if self._folded is None:
+            self._folded = FoldedLines(self, self._folder)
+        # Indices are always in ascending order.
+        if len(indices) > 0:
+            self._folded.update(indices[-1] + 1)
+        return self._folded.iter(indices)
+
+    def get_folded(self, index):
+        if self._folded is None:
+            self._folded = FoldedLines(self, self._folder)
+        self._folded.update(index + 1)
+        return self._folded.get(index)
+
+    def map_folded_ranges(self, index, ranges):
+        return self._folded.map_ranges(index, ranges)
+
+    def get_buffer(self, end, folded=False):
+        # The utf-8 text and offsets of the first end lines, for searching
+        # many lines at once.
+        if not folded:
+            return (self._text, self._offsets)
+        if self._folded is None:
+            self._folded = FoldedLines(self, self._folder)
+        self._folded.update(end)
+        return (self._folded._text, self._folded._offsets)
+
+    def iter(self, indices=None):
+        if indices is None:
+            indices = range(self.count())
+        if isinstance(indices, range) and self._split_safe:
+            return self._iter_range(indices)
+        else:
+            return ((index, self.get(index)) for index in indices)
+
+    def _iter_range(self, indices):
+        return chain.from_iterable(self._iter_range_blocks(indices))
+
+    def _iter_range_blocks(self, indices):
+        # Decoding a block at a time is much faster than line by line.
+        for start in range(indices.start, indices.stop, self.ITER_BLOCK_SIZE):
+            block = range(start, min(start+self.ITER_BLOCK_SIZE, indices.stop))
+            text = str(
+                self._text[self._offsets[block.start]:self._offsets[block.stop]-1],
+                *self.ENCODING
+            )
+            yield zip(block, text.split("\n"))
 
     def count(self):
-        return len(self._lines)
+        return len(self._offsets) - 1
 
     def get(self, index):
-        return self._lines[index]
+        return str(
+            self._text[self._offsets[index]:self._offsets[index+1]-1],
+            *self.ENCODING
+        )
 
-def unique(items):
-    result = []
-    seen = {}
-    for item in items:
-        if item not in seen:
-            seen[item] = True
-            result.append(item)
-    return result
+    def get_colors(self, index):
+        return self._colors.get(index, ())
+
+class SharedLines(Lines):
+
+    # The storage of Lines in shared memory. Layout: count, split safe flag,
+    # fold mode, count+1 offsets, text. Lines are folded when iterated since
+    # workers only search parts of them.
+
+    @staticmethod
+    def create(lines):
+        from multiprocessing import shared_memory
+        if isinstance(lines, MappedLines):
+            mode = lines._folder.mode
+            lines = Lines(line for (_, line) in lines.iter())
+            lines.set_fold_mode(mode)
+        count = lines.count()
+        header = array("Q", [
+            count,
+            lines._split_safe,
+            FOLD_MODES.index(lines._folder.mode)
+        ]).tobytes()
+        offsets = lines._offsets[:count+1].tobytes()
+        text = lines._text[:lines._offsets[count]]
+        memory = shared_memory.SharedMemory(
+            create=True,
+            size=max(1, len(header) + len(offsets) + len(text))
+        )
+        memory.buf[:len(header)] = header
+        memory.buf[len(header):len(header)+len(offsets)] = offsets
+        memory.buf[len(header)+len(offsets):len(header)+len(offsets)+len(text)] = text
+        return SharedLines(memory)
+
+    @staticmethod
+    def attach(name):
+        from multiprocessing import shared_memory
+        return SharedLines(shared_memory.SharedMemory(name=name))
+
+    def __init__(self, memory):
+        self._memory = memory
+        self.name = memory.name
+        item_size = array("Q").itemsize
+        count, split_safe, fold_mode = memory.buf[:item_size*3].cast("Q")
+        self._split_safe = bool(split_safe)
+        self._loading = False
+        self._folder = Folder(FOLD_MODES[fold_mode])
+        self._offsets = memory.buf[
+            item_size*3:item_size*(count+4)
+        ].cast("Q")
+        self._text = memory.buf[item_size*(count+4):]
+
+    def iter_folded(self, indices=None):
+        return (
+            (index, self._folder.fold(line)[0])
+            for (index, line)
+            in self.iter(indices)
+        )
+
+    def get_folded(self, index):
+        return self._folder.fold(self.get(index))[0]
+
+    def get_buffer(self, end, folded=False):
+        # Lines are folded as they are iterated, so only the unfolded text
+        # can be searched at once.
+        if folded:
+            return None
+        return Lines.get_buffer(self, end)
+
+    def map_folded_ranges(self, index, ranges):
+        _, mapping = self._folder.fold(self.get(index))
+        if mapping is None:
+            return ranges
+        else:
+            return map_folded_ranges(ranges, mapping)
+
+    def unlink(self):
+        self._offsets.release()
+        self._text.release()
+        self._memory.close()
+        self._memory.unlink()
+
+class FoldedLines(Lines):
+
+    # A folded copy of lines, stored the same way as Lines but without
+    # removing duplicates. It is extended on demand.
+
+    def __init__(self, lines, folder):
+        self._lines = lines
+        self._folder = folder
+        self._text = bytearray()
+        self._offsets = array("Q", [0])
+        self._split_safe = True
+        self._mappings = {}
+
+    def update(self, end):
+        start = self.count()
+        if end <= start:
+            return
+        folded_lines = []
+        for index, line in self._lines.iter(range(start, end)):
+            folded, mapping = self._folder.fold(line)
+            if mapping is not None:
+                self._mappings[index] = mapping
+            folded_lines.append(folded)
+        self._append_text(folded_lines)
+
+    def map_ranges(self, index, ranges):
+        mapping = self._mappings.get(index)
+        if mapping is None:
+            return ranges
+        else:
+            return map_folded_ranges(ranges, mapping)
+
+class MappedLines(Lines):
+
+    # Lines of a memory-mapped file. Only offsets of unique lines are
+    # stored, and lines are decoded when they are accessed. Lines are
+    # separated by newline, optionally preceded by carriage return. When
+    # escape sequences are removed, lines that only differ in them are
+    # duplicates. Lines are folded when they are accessed too, since a
+    # folded copy would take as much memory as the file. Lines appended to
+    # the file later can be added.
+
+    @staticmethod
+    def from_file_in_background(path, no_ansi_esc=False):
+        lines = MappedLines(path, no_ansi_esc)
+        lines._loading = True
+        thread = threading.Thread(target=lines.read_offsets, daemon=True)
+        thread.start()
+        return lines
+
+    CHUNK_SIZE = 1024*1024
+
+    def __init__(self, path, no_ansi_esc=False):
+        self._path = path
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size > 0:
+                import mmap
+                self._text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._text = b""
+        self._decoding = (locale.getpreferredencoding(False), "surrogateescape")
+        self._no_ansi_esc = no_ansi_esc
+        if no_ansi_esc:
+            self._parser = AnsiParser()
+            self._remove_escapes = re.compile(
+                ANSI_ESCAPE_PATTERN.encode("ascii")
+            ).sub
+        self._starts = array("Q")
+        self._ends = array("Q")
+        self._hashes = array("q")
+        self._slots = array("q", [-1]) * 8
+        self._loading = False
+        self._cancelled = False
+        # The end of the file when it was last read completely.
+        self._check = None
+        self._folder = Folder()
+
+    def read_appended_in_background(self):
+        # Returns False if the file was changed in other ways than appending
+        # lines to it, and has to be read again.
+        if self._loading or self._check is None:
+            return False
+        start = len(self._text)
+        if start > 0 and not self._check.endswith(b"\n"):
+            # The last line might have been completed.
+            return False
+        with open(self._path, "rb") as f:
+            f.seek(start - len(self._check))
+            if f.read(len(self._check)) != self._check:
+                return False
+            if os.fstat(f.fileno()).st_size > start:
+                import mmap
+                self._text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._loading = True
+        thread = threading.Thread(
+            target=self.read_offsets,
+            args=(start,),
+            daemon=True
+        )
+        thread.start()
+        return True
+
+    def cancel(self):
+        self._cancelled = True
+
+    def read_offsets(self, start=0):
+        try:
+            size = len(self._text)
+            while start < size:
+                if self._cancelled:
+                    return
+                end = self._text.rfind(b"\n", start, start+self.CHUNK_SIZE) + 1
+                if end <= start:
+                    end = self._text.find(b"\n", start+self.CHUNK_SIZE) + 1
+                    if end <= start:
+                        end = size
+                with STATS.time("dedup", bytes=end-start) as fields:
+                    count = self.count()
+                    self._add_chunk(start, self._text[start:end])
+                    fields["new_lines"] = self.count() - count
+                start = end
+            self._check = bytes(self._text[max(0, size-64):size])
+        finally:
+            self._loading = False
+
+    def _add_chunk(self, chunk_start, chunk):
+        keys = chunk.split(b"\n")
+        if chunk.endswith(b"\n"):
+            keys.pop()
+        starts = list(map(
+            operator.add,
+            accumulate(map(len, keys), initial=chunk_start),
+            range(len(keys))
+        ))
+        if b"\r" in chunk:
+            keys = [
+                key[:-1] if key.endswith(b"\r") else key
+                for key
+                in keys
+            ]
+        if self._no_ansi_esc and b"\x1b" in chunk:
+            self._add_keys_with_escapes(keys, starts)
+            return
+        # Duplicate keys keep the first position and the last start, which
+        # is fine since they are equal.
+        batch = dict(zip(keys, starts))
+        new_keys = self._find_new(batch)
+        new_starts = [batch[key] for key in new_keys]
+        self._starts.extend(new_starts)
+        # Ends are added last since they define the count.
+        self._ends.extend(map(operator.add, new_starts, map(len, new_keys)))
+
+    def _add_keys_with_escapes(self, keys, starts):
+        # Lines are compared without escape sequences. Equal lines keep the
+        # offsets, and so the colours, of the first one.
+        batch = {}
+        for (key, start) in zip(keys, starts):
+            end = start + len(key)
+            if b"\x1b" in key:
+                key = self._remove_escapes(b"", key)
+            batch.setdefault(key, (start, end))
+        new_offsets = [batch[key] for key in self._find_new(batch)]
+        self._starts.extend(start for (start, _) in new_offsets)
+        # Ends are added last since they define the count.
+        self._ends.extend(end for (_, end) in new_offsets)
+
+    def get_buffer(self, end, folded=False):
+        # The file is not utf-8 encoded and might contain escape sequences.
+        return None
+
+    def iter_folded(self, indices=None):
+        return (
+            (index, self._folder.fold(line)[0])
+            for (index, line)
+            in self.iter(indices)
+        )
+
+    def get_folded(self, index):
+        return self._folder.fold(self.get(index))[0]
+
+    def map_folded_ranges(self, index, ranges):
+        _, mapping = self._folder.fold(self.get(index))
+        if mapping is None:
+            return ranges
+        else:
+            return map_folded_ranges(ranges, mapping)
+
+    def iter(self, indices=None):
+        if indices is None:
+            indices = range(self.count())
+        return ((index, self.get(index)) for index in indices)
+
+    def count(self):
+        return len(self._ends)
+
+    def get(self, index):
+        line = str(self._get_raw(index), *self._decoding)
+        if self._no_ansi_esc:
+            (line, _) = self._parser.parse_alone(line)
+        return line
+
+    def get_colors(self, index):
+        # Lines are parsed on their own here, so colours don't carry over
+        # to following lines.
+        if not self._no_ansi_esc:
+            return ()
+        line = str(self._get_raw(index), *self._decoding)
+        return self._parser.parse_alone(line)[1]
+
+    def _get_key(self, index):
+        key = self._get_raw(index)
+        if self._no_ansi_esc and b"\x1b" in key:
+            return self._remove_escapes(b"", key)
+        return key
+
+    def _get_raw(self, index):
+        return self._text[self._starts[index]:self._ends[index]]
+
+def read_line_batches(stream, no_ansi_esc=False):
+    # Batches of lines and the colour spans of lines in them.
+    parser = AnsiParser() if no_ansi_esc else None
+    pending = []
+    for chunk in read_chunks(stream):
+        # Keep the last incomplete line until the rest of it arrives. Its
+        # chunks are only joined then, so long lines are not copied again
+        # for every chunk.
+        end = chunk.rfind("\n") + 1
+        if end == 0:
+            pending.append(chunk)
+            continue
+        pending.append(chunk[:end])
+        yield split_lines("".join(pending), parser)
+        pending = [chunk[end:]]
+    data = "".join(pending)
+    if data:
+        yield split_lines(data, parser)
+
+def split_lines(data, parser):
+    if parser is None:
+        return (data.splitlines(), {})
+    with STATS.time("strip_ansi", characters=len(data)):
+        return parser.split(data)
+
+def read_chunks(stream, size=64*1024):
+    # Read whatever is available so that slow producers are shown
+    # progressively. Text streams block until size characters are read.
+    buffer = getattr(stream, "buffer", None)
+    if hasattr(buffer, "read1"):
+        decoder = codecs.getincrementaldecoder(stream.encoding)(stream.errors)
+        while True:
+            with STATS.time("read") as fields:
+                data = buffer.read1(size)
+                fields["bytes"] = len(data)
+            if not data:
+                break
+            yield decoder.decode(data)
+        yield decoder.decode(b"", final=True)
+    else:
+        while True:
+            with STATS.time("read") as fields:
+                data = stream.read(size)
+                fields["characters"] = len(data)
+            if not data:
+                break
+            yield data
+
+def open_stdin_copy():
+    # The curses UI redirects stdin to the terminal, so lines must be read
+    # from a copy of it.
+    return io.open(
+        os.dup(sys.stdin.fileno()),
+        encoding="utf-8" if platform_is_windows() else sys.stdin.encoding,
+        errors=sys.stdin.errors
+    )
+
+HISTORY_CACHE_VERSION = 1
+
+def read_history(path, cache_path=None):
+    # Lines of a history file, newest first and without duplicates. A
+    # snapshot of them is cached. If the file has only grown since, just
+    # the lines at its end are read, and older copies of them are dropped
+    # from the snapshot without decoding it. A shell that has not written
+    # its history yet has no history file.
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return Lines([])
+    with f:
+        stat = os.fstat(f.fileno())
+        source = (HISTORY_CACHE_VERSION, os.path.abspath(path), stat.st_ino)
+        cached = read_cache(cache_path)
+        snapshot = None
+        check = b""
+        start = 0
+        if cached is not None and cached[0] == source:
+            (_, size, mtime, check, snapshot) = cached
+            if (size, mtime) == (stat.st_size, stat.st_mtime_ns):
+                return Lines.from_snapshot(snapshot)
+            # A file that was rewritten rather than appended to most likely
+            # has other bytes before the old end.
+            f.seek(max(0, size - len(check)))
+            if size <= stat.st_size and f.read(len(check)) == check:
+                start = size
+            else:
+                snapshot = None
+                check = b""
+        f.seek(start)
+        data = f.read()
+    text = data.decode(locale.getpreferredencoding(False), "surrogateescape")
+    lines = Lines(reversed(text.splitlines()))
+    if snapshot is not None:
+        new_keys = set(
+            line.encode(*Lines.ENCODING)
+            for (_, line)
+            in lines.iter()
+        )
+        lines._append_snapshot(*snapshot, skipped=[
+            index
+            for (index, key)
+            in enumerate(snapshot[0].split(b"\n"))
+            if key in new_keys
+        ])
+    # An incomplete last line might be completed later, so it is not cached.
+    if cache_path is not None and (data.endswith(b"\n") or not data):
+        write_cache(cache_path, (
+            source,
+            start + len(data),
+            stat.st_mtime_ns,
+            (check + data)[-64:],
+            lines.snapshot()
+        ))
+    return lines
+
+def filter_lines(batches, match, unique=False, limit=None):
+    # Batches of lines are filtered as they are read. Only lines already
+    # written are remembered, and only if duplicates should be skipped.
+    seen = set()
+    count = 0
+    for lines in batches:
+        matches = [line for line in lines if match(line)]
+        if unique:
+            matches = [
+                line
+                for line
+                in dict.fromkeys(matches)
+                if line not in seen
+            ]
+            seen.update(matches)
+        if limit is not None and count + len(matches) >= limit:
+            yield matches[:limit-count]
+            return
+        count += len(matches)
+        yield matches
+
+def get_filter_match_fn(expression, fold_mode="lower", fuzzy=False):
+    get_fn = get_fuzzy_match_fn if fuzzy else get_match_fn
+    if expression == expression.lower() and fold_mode != "lower":
+        folder = Folder(fold_mode)
+        match = get_fn(folder.fold_expression(expression), folded=True)
+        return lambda line: match(folder.fold(line)[0])
+    else:
+        return get_fn(expression)
+
+def run_filter(args):
+    if args["--file"] is not None:
+        stream = open(args["--file"], errors="surrogateescape")
+    else:
+        stream = io.open(
+            sys.stdin.fileno(),
+            encoding=sys.stdin.encoding,
+            errors="surrogateescape",
+            closefd=False
+        )
+    sys.stdout.reconfigure(errors="surrogateescape")
+    found = False
+    try:
+        for matches in filter_lines(
+            (
+                lines
+                for (lines, _)
+                in read_line_batches(stream, args["--no-ansi-esc"])
+            ),
+            get_filter_match_fn(
+                args["--filter"],
+                args["--fold"],
+                args["--fuzzy"]
+            ),
+            unique=args["--unique"],
+            limit=None if args["--limit"] is None else int(args["--limit"])
+        ):
+            if matches:
+                found = True
+                sys.stdout.write("\n".join(matches) + "\n")
+                sys.stdout.flush()
+    except BrokenPipeError:
+        # The reader has gone away, like head does after enough lines.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    return found
+
+# Arguments that the daemon needs to load lines and create a controller.
+DAEMON_ARGS = (
+    "--file",
+    "--history",
+    "--no-ansi-esc",
+    "--fold",
+    "--fuzzy",
+    "--index",
+    "--x-status",
+    "--tab",
+    "<initial-search-term>",
+)
+
+DAEMON_WATCH_INTERVAL_SECONDS = 1
+
+class Daemon(object):
+
+    # Keeps lines of files loaded, and their search functions created,
+    # between selections. Each connection gets its own controller, which
+    # renders to frames that are sent to the client. Requests are handled
+    # one at a time, since controllers share lines.
+
+    def __init__(self):
+        self._sources = {}
+        self._lock = threading.Lock()
+
+    def serve(self, rfile, wfile):
+        import json
+        session = DaemonSession(self)
+        try:
+            for request in rfile:
+                with self._lock:
+                    response = session.handle(json.loads(request))
+                wfile.write(json.dumps(response).encode("ascii") + b"\n")
+                wfile.flush()
+        finally:
+            with self._lock:
+                session.close()
+
+    def get_source(self, args):
+        key = (
+            args["--file"],
+            args["--history"],
+            args["--no-ansi-esc"],
+            args["--fold"],
+        )
+        source = self._sources.get(key)
+        if source is not None and source.is_stale():
+            if not source.read_appended():
+                source.close()
+                source = None
+        if source is None:
+            source = self._sources[key] = DaemonSource(args)
+        return source
+
+    def watch(self):
+        # Changed files are read again before a client asks for them.
+        while True:
+            time.sleep(DAEMON_WATCH_INTERVAL_SECONDS)
+            with self._lock:
+                sources = list(self._sources.values())
+            for source in sources:
+                if source.is_stale():
+                    with self._lock:
+                        self.get_source(source.args)
+
+class DaemonSource(object):
+
+    def __init__(self, args):
+        self.args = args
+        self._path = args["--file"] or args["--history"]
+        self._stat = self._read_stat()
+        self.lines = load_lines(args)
+        self._search_fns = {}
+
+    def is_stale(self):
+        # A file is only checked again once it has been read.
+        if self.lines.is_loading():
+            return False
+        return self._read_stat() != self._stat
+
+    def read_appended(self):
+        # Lines appended to a file are added to the lines that sessions and
+        # search functions already have.
+        stat = self._read_stat()
+        if (self.args["--file"] is None or
+                stat is None or
+                self._stat is None or
+                stat[0] != self._stat[0] or
+                not self.lines.read_appended_in_background()):
+            return False
+        self._stat = stat
+        return True
+
+    def get_search_fn(self, args):
+        key = (args["--fuzzy"], args["--index"], args["--x-status"])
+        if key not in self._search_fns:
+            self._search_fns[key] = get_search_fn(args, self.lines)
+        search_fn = self._search_fns[key]
+        # Sessions must not cancel each other's searches. Workers are
+        # shared, and only closed when the last session is done with them.
+        if hasattr(search_fn, "share"):
+            return search_fn.share()
+        return search_fn
+
+    def close(self):
+        if hasattr(self.lines, "cancel"):
+            self.lines.cancel()
+        for search_fn in self._search_fns.values():
+            if hasattr(search_fn, "close"):
+                search_fn.close()
+
+    def _read_stat(self):
+        try:
+            stat = os.stat(self._path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+class DaemonSession(object):
+
+    def __init__(self, daemon):
+        self._daemon = daemon
+        self._controller = None
+        self._screen = None
+        self._search_fn = None
+
+    def handle(self, request):
+        result = None
+        changed = True
+        if request[0] == "open":
+            (_, args, height, width) = request
+            source = self._daemon.get_source(args)
+            self.close()
+            self._search_fn = source.get_search_fn(args)
+            self._controller = create_controller(
+                args,
+                source.lines,
+                self._search_fn
+            )
+            self._screen = FrameScreen(height, width)
+            self._controller.setup(self._screen)
+        elif request[0] == "resize":
+            (_, height, width) = request
+            self._screen.size = (height, width)
+            self._controller.resize(self._screen)
+        elif request[0] == "update":
+            changed = self._controller.update()
+        elif request[0] == "input":
+            result = self._controller.process_inputs(request[1])
+            if result:
+                (action, selection) = result
+                result = (action.name, selection)
+        if changed and not result:
+            self._controller.render(self._screen)
+        return {
+            "rows": self._screen.rows,
+            "busy": self._controller.is_busy(),
+            "searching": self._controller.is_searching(),
+            "changed": changed,
+            "result": result,
+        }
+
+    def close(self):
+        if hasattr(self._search_fn, "close"):
+            self._search_fn.close()
+        self._search_fn = None
+
+class FrameScreen(object):
+
+    def __init__(self, height, width):
+        self.size = (height, width)
+        self.rows = []
+
+    def getmaxyx(self):
+        return self.size
+
+    def erase(self):
+        self.rows = []
+
+    def addstr(self, y, x, text, style):
+        self.rows.append((y, x, text, style))
+
+    def refresh(self):
+        pass
+
+class RemoteController(object):
+
+    # Used in place of a UiController. Input is sent to a controller in the
+    # daemon and the frames it renders are drawn.
+
+    ACTIONS = dict(
+        (action.name, action)
+        for action
+        in [ACTION_ENTER, ACTION_TAB, ACTION_ESC, ACTION_CTRL_C, ACTION_CTRL_G]
+    )
+
+    def __init__(self, connection, args):
+        import json
+        self._dumps = json.dumps
+        self._loads = json.loads
+        self._file = connection.makefile("rwb")
+        self._args = args
+        self._response = None
+
+    def setup(self, screen):
+        self._request(["open", self._args] + list(screen.getmaxyx()))
+
+    def resize(self, screen):
+        self._request(["resize"] + list(screen.getmaxyx()))
+
+    def is_busy(self):
+        return self._response["busy"]
+
+    def is_searching(self):
+        return self._response["searching"]
+
+    def update(self):
+        return self._request(["update"])["changed"]
+
+    def render(self, screen):
+        screen.erase()
+        for (y, x, text, style) in self._response["rows"]:
+            screen.addstr(y, x, text, style)
+        screen.refresh()
+
+    def process_input(self, unicode_character):
+        return self.process_inputs(unicode_character)
+
+    def process_inputs(self, unicode_characters):
+        result = self._request(["input", unicode_characters])["result"]
+        if result:
+            (name, selection) = result
+            return (self.ACTIONS[name], selection)
+
+    def _request(self, request):
+        self._file.write(self._dumps(request).encode("ascii") + b"\n")
+        self._file.flush()
+        self._response = self._loads(self._file.readline())
+        return self._response
+
+def run_daemon(path):
+    import socket
+    import socketserver
+
+    daemon = Daemon()
+
+    class Handler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+            daemon.serve(self.rfile, self.wfile)
+
+    if os.path.exists(path):
+        # A socket left behind by a daemon that did not exit cleanly.
+        connection = socket.socket(socket.AF_UNIX)
+        try:
+            connection.connect(path)
+        except OSError:
+            os.unlink(path)
+        else:
+            sys.exit("A daemon is already listening on {}".format(path))
+        finally:
+            connection.close()
+    # Only the user running the daemon can connect to it.
+    umask = os.umask(0o077)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(path, Handler)
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+    threading.Thread(target=daemon.watch, daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+def connect_daemon(path, args):
+    # Lines from stdin can't be sent to the daemon, and if no daemon is
+    # running, lines are read as usual.
+    if args["--file"] is None and args["--history"] is None:
+        return None
+    import socket
+    connection = socket.socket(socket.AF_UNIX)
+    try:
+        connection.connect(path)
+    except OSError:
+        connection.close()
+        return None
+    daemon_args = dict((name, args[name]) for name in DAEMON_ARGS)
+    for name in ["--file", "--history"]:
+        if daemon_args[name] is not None:
+            daemon_args[name] = os.path.abspath(daemon_args[name])
+    return RemoteController(connection, daemon_args)
 
 USAGE = """\
 I select stuff.
 
 Usage:
-  {name} [--tab] [--action] [--gui] [--x-status] [--no-ansi-esc] [--] [<initial-search-term>...]
+  {name} [--tab] [--action] [--gui] [--x-status] [--no-ansi-esc] [--index] [--fuzzy] [--file <path> | --history <path>] [--fold <mode>] [--connect <socket>] [--stats <path>] [--profile <path>] [--] [<initial-search-term>...]
+  {name} --filter <term> [--unique] [--limit <n>] [--no-ansi-esc] [--fuzzy] [--file <path>] [--fold <mode>]
+  {name} --daemon <socket> [--stats <path>]
   {name} (-h | --help)
 
 Options:
@@ -386,7 +2816,34 @@ Options:
   --action      Print the action taken on the first line.
   --gui         Use GUI version instead of console version.
   --x-status    Extended information in status line.
-  --no-ansi-esc Remove ansi escape sequences for coloring from input.
+  --no-ansi-esc Remove ansi escape sequences from input, and show the
+                colours they set.
+  --index       Build a trigram index to speed up searching large inputs.
+  --fuzzy       Match characters of terms in order and show the best
+                scored matches first.
+  --file <path> Read lines from a memory-mapped file instead of stdin.
+  --history <path>
+                Read lines from a shell history file, newest first. The
+                lines are cached, and only new lines are read next time.
+  --fold <mode> How lowercase searches fold lines: lower (default),
+                casefold, or accents (casefold and ignore accents).
+  --filter <term>
+                Write lines matching the term to stdout as they are read,
+                without a UI. Fails if no line matched.
+  --unique      Only write the first of equal lines when filtering.
+  --limit <n>   Stop filtering after this many lines.
+  --daemon <socket>
+                Listen on a Unix socket and keep lines of files and
+                histories loaded for clients. Files are read again when
+                they change.
+  --connect <socket>
+                Select among lines that a daemon has loaded, if one
+                listens on the socket. Only with --file or --history.
+  --stats <path>
+                Write how long reading, searching and rendering takes to
+                a file, one JSON object per line.
+  --profile <path>
+                Write a cProfile dump of the main thread to a file.
   -h,  --help   Show this message and exit.
 """.format(
     name=os.path.basename(__file__)
@@ -397,28 +2854,102 @@ def main():
     if args["-h"] or args["--help"]:
         usage()
         success()
+    if args["--fold"] not in FOLD_MODES:
+        usage()
+        fail()
+    if args["--limit"] is not None and not args["--limit"].isdigit():
+        usage()
+        fail()
+    if args["--stats"] is not None:
+        STATS.open(args["--stats"])
+    if args["--profile"] is not None:
+        start_profile(args["--profile"])
     locale.setlocale(locale.LC_ALL, "")
+    if args["--filter"] is not None:
+        if run_filter(args):
+            success()
+        else:
+            fail()
+    if args["--daemon"] is not None:
+        run_daemon(args["--daemon"])
+        success()
+    controller = None
+    if args["--connect"] is not None:
+        controller = connect_daemon(args["--connect"], args)
+    if controller is None:
+        controller = create_controller(args, load_lines(args))
     (action, result) = get_ui_fn(args)(
-        Config(os.path.expanduser("~/.rlselect.cfg")),
-        UiController(
-            lines=Lines.from_stream(sys.stdin, no_ansi_esc=args["--no-ansi-esc"]),
-            term=(" ".join(args["<initial-search-term>"])),
-            search_fn=search,
-            tab_exits=args["--tab"],
-            extended_status_line=args["--x-status"]
-        )
+        Config(
+            os.path.expanduser("~/.rlselect.cfg"),
+            os.path.join(get_cache_dir(), "config")
+        ),
+        controller
     )
     if args["--action"]:
         print(action.name)
     if action.abort:
         fail()
     else:
-        print(result)
+        write_line(result)
         success()
 
+def write_line(line):
+    # Undecodable bytes of lines are kept as surrogates, and are written as
+    # the same bytes.
+    sys.stdout.reconfigure(errors="surrogateescape")
+    print(line)
+
+def replace_surrogates(text):
+    return text.encode("utf-8", "replace").decode("utf-8")
+
+def load_lines(args):
+    if args["--file"] is not None:
+        lines = MappedLines.from_file_in_background(
+            args["--file"],
+            no_ansi_esc=args["--no-ansi-esc"]
+        )
+    elif args["--history"] is not None:
+        lines = read_history(
+            args["--history"],
+            get_history_cache_path(args["--history"])
+        )
+    else:
+        lines = Lines.from_stream_in_background(
+            open_stdin_copy(),
+            no_ansi_esc=args["--no-ansi-esc"]
+        )
+    lines.set_fold_mode(args["--fold"])
+    return lines
+
+def create_controller(args, lines, search_fn=None):
+    return UiController(
+        lines=lines,
+        term=(" ".join(args["<initial-search-term>"])),
+        search_fn=search_fn or get_search_fn(args, lines),
+        tab_exits=args["--tab"],
+        extended_status_line=args["--x-status"]
+    )
+
+def start_profile(path):
+    import cProfile
+    profile = cProfile.Profile()
+    # The profile is written when exiting with success() or fail().
+    atexit.register(profile.dump_stats, path)
+    profile.enable()
+
 def platform_is_windows():
     return sys.platform.startswith("win32")
 
+def get_search_fn(args, lines):
+    if args["--fuzzy"]:
+        return FuzzySearch()
+    elif args["--index"]:
+        return TrigramIndex(lines).search
+    elif args["--x-status"]:
+        return ParallelSearch()
+    else:
+        return MultiTermSearch()
+
 def get_ui_fn(args):
     if platform_is_windows() or args["--gui"]:
         import wx
@@ -448,6 +2979,13 @@ def get_ui_fn(args):
                 wx.Frame.__init__(self, None, size=config.get_gui_size())
                 self._screen = WxScreen(self, app, config, controller)
 
+        SPECIAL_KEYS = {
+            wx.WXK_DOWN: CTRL_N,
+            wx.WXK_UP: CTRL_P,
+            wx.WXK_PAGEDOWN: CTRL_F,
+            wx.WXK_PAGEUP: CTRL_B,
+        }
+
         class WxScreen(wx.Panel):
 
             def __init__(self, parent, app, config, controller):
@@ -456,17 +2994,43 @@ def get_ui_fn(args):
                 self._config = config
                 self._controller = controller
                 self._surface_bitmap = None
-                self._commands = []
+                self._surface_size = None
+                self._rows = {}
+                self._drawn_rows = {}
                 self._init_fonts()
+                self._init_styles()
                 self.SetBackgroundStyle(wx.BG_STYLE_CUSTOM)
                 self.Bind(wx.EVT_CHAR, self._on_key_down)
                 self.Bind(wx.EVT_PAINT, self._on_paint)
                 self.Bind(wx.EVT_SIZE, self._on_size)
+                self._update_scheduled = False
+                self._set_up = False
+                self._pending_input = []
                 wx.CallAfter(self._after_init)
 
             def _after_init(self):
                 self._controller.setup(self)
+                self._set_up = True
                 self._controller.render(self)
+                self._schedule_update()
+
+            def _schedule_update(self):
+                if self._update_scheduled:
+                    return
+                if self._controller.is_searching():
+                    # Let pending key events be handled before continuing.
+                    wx.CallAfter(self._on_update)
+                elif self._controller.is_busy():
+                    wx.CallLater(POLL_INTERVAL_MS, self._on_update)
+                else:
+                    return
+                self._update_scheduled = True
+
+            def _on_update(self):
+                self._update_scheduled = False
+                if self._controller.update():
+                    self._controller.render(self)
+                self._schedule_update()
 
             def getmaxyx(self):
                 ww, wh = self.GetSize()
@@ -475,43 +3039,50 @@ def get_ui_fn(args):
                 return (int(max_y), int(max_x))
 
             def erase(self):
-                self._commands = []
+                self._rows = {}
 
             def addstr(self, y, x, text, style):
-                self._commands.append((y, x, text, style))
+                self._rows.setdefault(y, []).append((x, text, style))
 
             def refresh(self):
+                # The back buffer is kept between frames, and only rows
+                # that differ from the previous frame are drawn again.
                 width, height = self.GetSize()
-                self._surface_bitmap = wx.Bitmap(width, height)
+                if self._surface_size != (width, height):
+                    self._surface_bitmap = wx.Bitmap(width, height)
+                    self._surface_size = (width, height)
+                    self._drawn_rows = None
                 memdc = wx.MemoryDC()
                 memdc.SelectObject(self._surface_bitmap)
-                memdc.SetBackground(wx.Brush(
-                    self._config.get_rgb("BACKGROUND"), wx.SOLID
-                ))
                 memdc.SetBackgroundMode(wx.PENSTYLE_SOLID)
-                memdc.Clear()
-                for (y, x, text, style) in self._commands:
-                    if style == "highlight":
-                        memdc.SetFont(self._base_font_bold)
-                        fg = self._config.get_rgb(self._config.get_highlight_fg())
-                        bg = self._config.get_rgb(self._config.get_highlight_bg())
-                    elif style == "select":
-                        memdc.SetFont(self._base_font_bold)
-                        fg = self._config.get_rgb(self._config.get_selection_fg())
-                        bg = self._config.get_rgb(self._config.get_selection_bg())
-                    elif style == "status":
-                        memdc.SetFont(self._base_font_bold)
-                        fg = self._config.get_rgb("BACKGROUND")
-                        bg = self._config.get_rgb("FOREGROUND")
-                    else:
-                        memdc.SetFont(self._base_font)
-                        fg = self._config.get_rgb("FOREGROUND")
-                        bg = self._config.get_rgb("BACKGROUND")
-                    memdc.SetTextBackground(bg)
-                    memdc.SetTextForeground(fg)
-                    memdc.DrawText(text, x*self._fw, y*self._fh)
+                memdc.SetPen(wx.TRANSPARENT_PEN)
+                memdc.SetBrush(self._background_brush)
+                if self._drawn_rows is None:
+                    memdc.SetBackground(self._background_brush)
+                    memdc.Clear()
+                    self._drawn_rows = {}
+                dirty_rects = []
+                for y in set(self._rows).union(self._drawn_rows):
+                    row = self._rows.get(y, [])
+                    if row == self._drawn_rows.get(y, []):
+                        continue
+                    rect = wx.Rect(0, y*self._fh, width, self._fh)
+                    memdc.DrawRectangle(rect)
+                    for (x, text, style) in row:
+                        font, fg, bg = self._get_style(style)
+                        memdc.SetFont(font)
+                        memdc.SetTextBackground(bg)
+                        memdc.SetTextForeground(fg)
+                        memdc.DrawText(
+                            replace_surrogates(text),
+                            x*self._fw,
+                            y*self._fh
+                        )
+                    dirty_rects.append(rect)
+                self._drawn_rows = self._rows
                 del memdc
-                self.Refresh()
+                for rect in dirty_rects:
+                    self.RefreshRect(rect, eraseBackground=False)
                 self.Update()
 
             def _init_fonts(self):
@@ -524,6 +3095,60 @@ def get_ui_fn(args):
                 self._base_font_bold = self._base_font.Bold()
                 self._find_text_size()
 
+            def _init_styles(self):
+                def colour(name):
+                    return wx.Colour(*self._config.get_rgb(name))
+                background = colour("BACKGROUND")
+                foreground = colour("FOREGROUND")
+                self._background_brush = wx.Brush(background, wx.SOLID)
+                self._styles = {
+                    "highlight": (
+                        self._base_font_bold,
+                        colour(self._config.get_highlight_fg()),
+                        colour(self._config.get_highlight_bg()),
+                    ),
+                    "select": (
+                        self._base_font_bold,
+                        colour(self._config.get_selection_fg()),
+                        colour(self._config.get_selection_bg()),
+                    ),
+                    "status": (
+                        self._base_font_bold,
+                        background,
+                        foreground,
+                    ),
+                    "default": (
+                        self._base_font,
+                        foreground,
+                        background,
+                    ),
+                }
+
+            def _get_style(self, style):
+                # Colours of lines are turned into styles when they are
+                # first drawn.
+                if style not in self._styles:
+                    if not style.startswith("ansi:"):
+                        return self._styles["default"]
+                    self._styles[style] = self._get_ansi_style(
+                        parse_ansi_style(style)
+                    )
+                return self._styles[style]
+
+            def _get_ansi_style(self, state):
+                font, fg, bg = self._styles["default"]
+                if state.fg is not None:
+                    fg = wx.Colour(*get_ansi_rgb(state.fg))
+                if state.bg is not None:
+                    bg = wx.Colour(*get_ansi_rgb(state.bg))
+                if state.bold:
+                    font = self._base_font_bold
+                if state.underline:
+                    font = font.Underlined()
+                if state.reverse:
+                    fg, bg = bg, fg
+                return (font, fg, bg)
+
             def _find_text_size(self):
                 bitmap = wx.Bitmap(100, 100)
                 memdc = wx.MemoryDC()
@@ -532,11 +3157,26 @@ def get_ui_fn(args):
                 self._fw, self._fh = memdc.GetTextExtent(".")
 
             def _on_key_down(self, evt):
-                result = self._controller.process_input(chr(evt.GetUnicodeKey()))
+                # Key events that are already queued are handled together.
+                if not self._pending_input:
+                    wx.CallAfter(self._process_pending_input)
+                if evt.GetUnicodeKey() == wx.WXK_NONE:
+                    self._pending_input.append(
+                        SPECIAL_KEYS.get(evt.GetKeyCode(), "")
+                    )
+                else:
+                    self._pending_input.append(chr(evt.GetUnicodeKey()))
+
+            def _process_pending_input(self):
+                unicode_characters = "".join(self._pending_input)
+                self._pending_input = []
+                result = self._controller.process_inputs(unicode_characters)
                 if result:
                     self._app.set_result(result)
                     self.GetParent().Close()
+                    return
                 self._controller.render(self)
+                self._schedule_update()
 
             def _on_paint(self, event):
                 dc = wx.AutoBufferedPaintDC(self)
@@ -544,10 +3184,13 @@ def get_ui_fn(args):
                     dc.DrawBitmap(self._surface_bitmap, 0, 0, True)
 
             def _on_size(self, event):
-                self._after_init()
+                if not self._set_up:
+                    return
+                self._controller.resize(self)
+                self._controller.render(self)
+                self._schedule_update()
         return wx_ui_run
     else:
-        import contextlib
         import curses
 
         COLOR_MAP = {
@@ -585,6 +3228,12 @@ def get_ui_fn(args):
 
         def _run(screen, config, controller):
             curses.raw()
+            attributes = {
+                "default": 0,
+                "highlight": curses.A_BOLD,
+                "select": curses.A_BOLD,
+                "status": curses.A_REVERSE | curses.A_BOLD,
+            }
             if curses.has_colors():
                 curses.use_default_colors()
                 curses.init_pair(
@@ -597,71 +3246,155 @@ def get_ui_fn(args):
                     COLOR_MAP[config.get_selection_fg()],
                     COLOR_MAP[config.get_selection_bg()]
                 )
+                attributes["highlight"] |= curses.color_pair(1)
+                attributes["select"] |= curses.color_pair(2)
             controller.setup(screen)
-            return _loop(controller, screen)
+            return _loop(controller, screen, attributes)
+
+        SPECIAL_KEYS = {
+            curses.KEY_BACKSPACE: BS,
+            curses.KEY_ENTER: CR,
+            curses.KEY_DOWN: CTRL_N,
+            curses.KEY_UP: CTRL_P,
+            curses.KEY_NPAGE: CTRL_F,
+            curses.KEY_PPAGE: CTRL_B,
+        }
 
-        def _loop(controller, screen):
-            patched_screen = _Screen(screen)
-            buf = b""
+        def _loop(controller, screen, attributes):
+            patched_screen = _Screen(screen, attributes)
+            decoder = codecs.getincrementaldecoder(
+                locale.getpreferredencoding()
+            )(errors="ignore")
+            render = True
             while True:
-                controller.render(patched_screen)
+                if render:
+                    controller.render(patched_screen)
+                render = True
+                if controller.is_searching():
+                    screen.timeout(0)
+                elif controller.is_busy():
+                    screen.timeout(POLL_INTERVAL_MS)
+                else:
+                    screen.timeout(-1)
                 ch = screen.getch()
-                if ch > 255:
-                    if ch == curses.KEY_BACKSPACE:
-                        buf = BS.encode(locale.getpreferredencoding())
-                    elif ch == curses.KEY_ENTER:
-                        buf = CR.encode(locale.getpreferredencoding())
+                if ch == -1:
+                    render = controller.update()
+                    continue
+                # Input that is already waiting is handled together with
+                # this key, so that a paste only causes one search.
+                screen.timeout(0)
+                unicode_characters = ""
+                while ch != -1:
+                    if ch == curses.KEY_RESIZE:
+                        controller.resize(patched_screen)
+                    elif ch > 255:
+                        # Special keys end incomplete multi-byte characters.
+                        decoder.reset()
+                        unicode_characters += SPECIAL_KEYS.get(ch, "")
                     else:
-                        buf = b""
-                        continue
-                else:
-                    buf += bytes([ch])
-                try:
-                    unicode_character = buf.decode(locale.getpreferredencoding())
-                except UnicodeDecodeError:
-                    # We are dealing with an incomplete multi-byte character.
-                    pass
-                else:
-                    buf = b""
-                    result = controller.process_input(unicode_character)
-                    if result:
-                        return result
+                        unicode_characters += decoder.decode(bytes([ch]))
+                    ch = screen.getch()
+                result = controller.process_inputs(unicode_characters)
+                if result:
+                    return result
 
         class _Screen(object):
 
-            def __init__(self, curses_screen):
+            # Rows are collected for a frame and only drawn if they differ
+            # from the previous frame. Curses only sends changed cells of
+            # the rows that are drawn.
+
+            def __init__(self, curses_screen, attributes):
                 self._curses_screen = curses_screen
+                self._attributes = attributes
+                self._encoding = locale.getpreferredencoding()
+                self._size = None
+                self._rows = {}
+                self._drawn_rows = {}
+                self._last = None
+                self._pairs = {}
 
             def getmaxyx(self):
                 return self._curses_screen.getmaxyx()
 
             def erase(self):
-                return self._curses_screen.erase()
+                self._rows = {}
+                self._last = None
 
             def addstr(self, y, x, text, style):
-                if style == "highlight":
-                    attrs = curses.A_BOLD
-                    if curses.has_colors():
-                        attrs |= curses.color_pair(1)
-                elif style == "select":
-                    attrs = curses.A_BOLD
-                    if curses.has_colors():
-                        attrs |= curses.color_pair(2)
-                elif style == "status":
-                    attrs = curses.A_REVERSE | curses.A_BOLD
-                else:
-                    attrs = 0
+                self._rows.setdefault(y, []).append((x, text, style))
+                self._last = (y, x, text, style)
+
+            def refresh(self):
+                size = self._curses_screen.getmaxyx()
+                if size != self._size:
+                    self._curses_screen.erase()
+                    self._size = size
+                    self._drawn_rows = {}
+                for y in set(self._rows).union(self._drawn_rows):
+                    if y >= size[0]:
+                        # Rows below a very small terminal can't be moved to.
+                        continue
+                    row = self._rows.get(y, [])
+                    if row != self._drawn_rows.get(y, []):
+                        self._curses_screen.move(y, 0)
+                        self._curses_screen.clrtoeol()
+                        for (x, text, style) in row:
+                            self._addstr(y, x, text, style)
+                self._drawn_rows = self._rows
+                if self._last is not None:
+                    # The cursor is left where the last text was written.
+                    self._addstr(*self._last)
+                return self._curses_screen.refresh()
+
+            def _addstr(self, y, x, text, style):
                 try:
-                    self._curses_screen.addstr(y, x, self._encode(text), attrs)
+                    self._curses_screen.addstr(
+                        y,
+                        x,
+                        # Undecodable bytes of lines are shown as "?".
+                        text.encode(self._encoding, "replace"),
+                        self._get_attribute(style)
+                    )
                 except curses.error:
                     # Writing last position (max_y, max_x) fails, but we can ignore it.
                     pass
 
-            def refresh(self):
-                return self._curses_screen.refresh()
-
-            def _encode(self, text):
-                return text.encode(locale.getpreferredencoding())
+            def _get_attribute(self, style):
+                # Colours of lines are turned into attributes when they are
+                # first drawn.
+                if style not in self._attributes:
+                    if not style.startswith("ansi:"):
+                        return 0
+                    self._attributes[style] = self._get_ansi_attribute(
+                        parse_ansi_style(style)
+                    )
+                return self._attributes[style]
+
+            def _get_ansi_attribute(self, state):
+                attribute = 0
+                if state.bold:
+                    attribute |= curses.A_BOLD
+                if state.underline:
+                    attribute |= curses.A_UNDERLINE
+                if state.reverse:
+                    attribute |= curses.A_REVERSE
+                colors = (state.fg, state.bg)
+                if colors != (None, None) and curses.has_colors():
+                    if colors not in self._pairs:
+                        # Pairs 1 and 2 are used by the theme.
+                        pair = len(self._pairs) + 3
+                        if pair >= min(curses.COLOR_PAIRS, 256):
+                            return attribute
+                        curses.init_pair(pair, *[
+                            -1 if color is None else
+                            get_ansi_color_index(color, curses.COLORS)
+                            for color
+                            in colors
+                        ])
+                        self._pairs[colors] = pair
+                    attribute |= curses.color_pair(self._pairs[colors])
+                return attribute
         return curses_ui_run
 
 def parse_args():
@@ -673,6 +3406,18 @@ def parse_args():
         "--gui": False,
         "--x-status": False,
         "--no-ansi-esc": False,
+        "--index": False,
+        "--fuzzy": False,
+        "--file": None,
+        "--history": None,
+        "--fold": "lower",
+        "--stats": None,
+        "--profile": None,
+        "--filter": None,
+        "--unique": False,
+        "--limit": None,
+        "--daemon": None,
+        "--connect": None,
         "<initial-search-term>": [],
     }
     rest = sys.argv[1:]
@@ -698,6 +3443,42 @@ def parse_args():
         elif rest[:1] == ["--no-ansi-esc"]:
             args["--no-ansi-esc"] = True
             rest = rest[1:]
+        elif rest[:1] == ["--index"]:
+            args["--index"] = True
+            rest = rest[1:]
+        elif rest[:1] == ["--fuzzy"]:
+            args["--fuzzy"] = True
+            rest = rest[1:]
+        elif rest[:1] == ["--file"] and len(rest) > 1:
+            args["--file"] = rest[1]
+            rest = rest[2:]
+        elif rest[:1] == ["--history"] and len(rest) > 1:
+            args["--history"] = rest[1]
+            rest = rest[2:]
+        elif rest[:1] == ["--fold"] and len(rest) > 1:
+            args["--fold"] = rest[1]
+            rest = rest[2:]
+        elif rest[:1] == ["--filter"] and len(rest) > 1:
+            args["--filter"] = rest[1]
+            rest = rest[2:]
+        elif rest[:1] == ["--unique"]:
+            args["--unique"] = True
+            rest = rest[1:]
+        elif rest[:1] == ["--limit"] and len(rest) > 1:
+            args["--limit"] = rest[1]
+            rest = rest[2:]
+        elif rest[:1] == ["--daemon"] and len(rest) > 1:
+            args["--daemon"] = rest[1]
+            rest = rest[2:]
+        elif rest[:1] == ["--connect"] and len(rest) > 1:
+            args["--connect"] = rest[1]
+            rest = rest[2:]
+        elif rest[:1] == ["--stats"] and len(rest) > 1:
+            args["--stats"] = rest[1]
+            rest = rest[2:]
+        elif rest[:1] == ["--profile"] and len(rest) > 1:
+            args["--profile"] = rest[1]
+            rest = rest[2:]
         elif rest[:1] == ["--"]:
             args["<initial-search-term>"] = rest[1:]
             rest = []
@@ -17,19 +17,54 @@
 
 from io import StringIO
 from unittest.mock import Mock
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
 import pytest
 
 from rlselect import (
     Action,
+    AnsiParser,
+    compile_query,
     Config,
     CR,
     CTRL_C,
     CTRL_G,
+    CTRL_B,
+    CTRL_F,
+    CTRL_N,
+    CTRL_P,
     ESC,
+    BS,
+    CTRL_W,
+    Daemon,
+    DAEMON_ARGS,
+    filter_lines,
+    find_matches,
+    fit_display_width,
+    FuzzySearch,
+    get_filter_match_fn,
+    get_search_fn,
+    is_refinement,
     LF,
     Lines,
+    read_history,
+    read_line_batches,
+    RemoteController,
+    MappedLines,
+    MultiTermSearch,
+    ParallelSearch,
     search,
+    SearchResult,
+    Stats,
     TAB,
+    TopMatches,
+    TrigramIndex,
     UiController,
 )
 
@@ -93,6 +128,29 @@ YELLOW = 10, 10, 10
     assert config.get_gui_font_size() == 20
     assert config.get_gui_size() == (1000, 1000)
 
+def test_config_is_cached_until_changed(tmpdir):
+    config_path = str(tmpdir.join("example.cfg"))
+    cache_path = str(tmpdir.join("cache", "config"))
+    tmpdir.join("example.cfg").write("[theme]\nhighlight_fg = BLUE\n")
+    assert Config(config_path, cache_path).get_highlight_fg() == "BLUE"
+    assert tmpdir.join("cache", "config").check()
+    assert Config(config_path, cache_path).get_highlight_fg() == "BLUE"
+    tmpdir.join("example.cfg").write("[theme]\nhighlight_fg = YELLOW\n")
+    assert Config(config_path, cache_path).get_highlight_fg() == "YELLOW"
+
+def test_missing_config_uses_defaults(tmpdir):
+    config = Config(str(tmpdir.join("missing.cfg")), str(tmpdir.join("cache")))
+    assert config.get_highlight_fg() == "RED"
+    assert not tmpdir.join("cache").check()
+
+def test_import_does_not_load_configparser():
+    output = subprocess.check_output([
+        sys.executable,
+        "-c",
+        "import sys, rlselect; print('configparser' in sys.modules)",
+    ], cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert output.strip() == b"False"
+
 def test_filter():
     lines = Lines([
         "one",
@@ -178,18 +236,21 @@ def test_return_values(kwargs, input_, expected_output):
     assert create_controller(**kwargs).process_input(input_) == expected_output
 
 def create_controller(tab_exits=False):
-    screen = Mock()
-    screen.getmaxyx.return_value = (100,  100)
     controller = UiController(
         Lines([]),
         "",
-        lambda x, y: [],
+        lambda lines, term, indices: [],
         tab_exits,
         False,
     )
-    controller.setup(screen)
+    controller.setup(create_screen())
     return controller
 
+def create_screen(height=100, width=100):
+    screen = Mock()
+    screen.getmaxyx.return_value = (height,  width)
+    return screen
+
 def test_splits_stream_into_lines():
     assert get_lines("one\ntwo\r\nthree\rfour\n") == [
         u"one",
@@ -198,6 +259,79 @@ def test_splits_stream_into_lines():
         u"four",
     ]
 
+def test_ansi_parser_strips_sequences_and_keeps_colours():
+    assert AnsiParser().split(
+        "\x1b[1;31mred\x1b[0m plain\n"
+        "\x1b[38;5;208mor\x1b[48;2;1;2;3mange\n"
+        "still\x1b[m\x1b[K end\x1b]0;title\x07\n"
+    ) == (
+        ["red plain", "orange", "still end"],
+        {
+            0: ((0, 3, "ansi:1::b"),),
+            1: ((0, 2, "ansi:208::"), (2, 6, "ansi:208:#010203:")),
+            2: ((0, 5, "ansi:208:#010203:"),),
+        },
+    )
+
+@pytest.mark.parametrize("sequence", [
+    "\x1b[38;2;1m",
+    "\x1b[48;2m",
+    "\x1b[38:2:1m",
+    "\x1b[38;5m",
+    "\x1b[38;5;m",
+])
+def test_ansi_parser_ignores_malformed_colours(sequence):
+    assert AnsiParser().split(sequence + "text\n") == (["text"], {})
+
+def test_lines_keep_colours_of_first_duplicate():
+    lines = Lines.from_stream(
+        StringIO("\x1b[32mdup\x1b[0m\nother\ndup\n"),
+        no_ansi_esc=True
+    )
+    assert [lines.get(index) for index in range(lines.count())] == [
+        "dup",
+        "other",
+    ]
+    assert lines.get_colors(0) == ((0, 3, "ansi:2::"),)
+    assert lines.get_colors(1) == ()
+
+def test_highlights_are_drawn_over_colours():
+    lines = Lines.from_stream(
+        StringIO("ee x\n\x1b[32mgreen\x1b[0m text\n"),
+        no_ansi_esc=True
+    )
+    controller = UiController(lines, "ee x", MultiTermSearch(), False, True)
+    controller.setup(create_screen())
+    while controller.is_busy():
+        controller.update()
+    screen = create_screen()
+    controller.render(screen)
+    # The first line is selected, and the selection hides colours.
+    assert [
+        call.args
+        for call
+        in screen.addstr.call_args_list
+        if call.args[0] == 3
+    ] == [
+        (3, 0, "gr", "ansi:2::"),
+        (3, 2, "ee", "highlight"),
+        (3, 4, "n", "ansi:2::"),
+        (3, 5, " te", "default"),
+        (3, 8, "x", "highlight"),
+        (3, 9, "t", "default"),
+    ]
+
+def test_lines_split_across_chunks_are_joined(monkeypatch):
+    monkeypatch.setattr(
+        "rlselect.read_chunks",
+        lambda stream: iter(["lo", "ng", " line\nne", "xt\n", "last"])
+    )
+    assert [lines for (lines, _) in read_line_batches(StringIO())] == [
+        ["long line"],
+        ["next"],
+        ["last"],
+    ]
+
 def test_skips_duplicate_lines():
     assert get_lines("dup\ndup") == [
         u"dup",
@@ -210,3 +344,728 @@ def get_lines(binary):
         for index
         in range(lines.count())
     ]
+
+@pytest.mark.parametrize("old,new,expected", [
+    ("",        "foo",      True),
+    ("fo",      "foo",      True),
+    ("foo",     "fo",       False),
+    ("foo",     "foo bar",  True),
+    ("foo bar", "bar",      False),
+    ("foo",     "Foo",      True),
+    ("Foo",     "foo",      False),
+    ("foo",     "foo !bar", True),
+    ("foo !ba", "foo !bar", False),
+    ("!bar",    "foo !bar", True),
+    ("!bar",    "!Bar",     False),
+    ("foo !",   "foo !b",   True),
+    ("!",       "!!x",      True),
+    ("!x",      "!!x",      False),
+])
+def test_is_refinement(old, new, expected):
+    assert is_refinement(old, new) == expected
+
+@pytest.mark.parametrize("terms", [
+    ["o", "on", "one", "one !x"],
+    ["t", "th", "thr", "tHr"],
+    ["e", "e !t", "e !t o"],
+    ["", "!", "!t", "!t e"],
+])
+def test_refined_search_matches_full_search(terms):
+    lines = Lines(["one", "two", "three", "tHree", "x one", "!t e"] * 3)
+    controller = UiController(lines, "", find_matches, False, False)
+    controller.setup(create_screen(3))
+    for term in terms:
+        controller._set_term(term)
+        assert controller._result.fetch() == list(find_matches(lines, term))
+
+def test_reads_stream_in_background():
+    lines = Lines.from_stream_in_background(StringIO("one\ntwo\none\n"))
+    while lines.is_loading():
+        pass
+    assert [line for (_, line) in lines.iter()] == ["one", "two"]
+
+def test_search_extends_to_lines_that_arrive_later():
+    lines = Lines(["one", "two"])
+    controller = UiController(lines, "o", find_matches, False, True)
+    controller.setup(create_screen())
+    assert not controller.update()
+    lines.read_stream(StringIO("zero\nthree\none\n"))
+    assert controller.update()
+    assert controller._result.fetch() == list(find_matches(lines, "o"))
+    assert controller._total_nbr_of_matched_lines == 3
+
+def test_search_is_done_in_slices(monkeypatch):
+    monkeypatch.setattr(SearchResult, "BLOCK_SIZE", 1)
+    monkeypatch.setattr("rlselect.SEARCH_SLICE_SECONDS", 0)
+    lines = Lines(["a1", "b", "a2", "a3"])
+    controller = UiController(lines, "", find_matches, False, True)
+    controller.setup(create_screen())
+    controller.process_input("a")
+    assert controller.is_searching()
+    assert controller._total_nbr_of_matched_lines == 1
+    while controller.update():
+        pass
+    assert not controller.is_busy()
+    assert controller._total_nbr_of_matched_lines == 3
+
+def test_lines_that_arrive_after_first_screenful_are_counted():
+    lines = Lines(["a{}".format(x) for x in range(10)])
+    controller = UiController(lines, "a", find_matches, False, False)
+    controller.setup(create_screen(5))
+    lines.read_stream(StringIO("".join("a{}\n".format(x) for x in range(10, 20))))
+    assert controller.update()
+    assert not controller.is_busy()
+    assert controller._matches == [0, 1, 2]
+    assert "among 20 lines" in controller._get_status_text()
+    controller.process_inputs(CTRL_F + CTRL_F + CTRL_F + CTRL_F)
+    assert controller._matches[-1] == 14
+
+def test_lines_that_arrive_during_search_are_searched(monkeypatch):
+    monkeypatch.setattr(SearchResult, "BLOCK_SIZE", 1)
+    monkeypatch.setattr("rlselect.SEARCH_SLICE_SECONDS", 0)
+    lines = Lines(["x1", "x2", "x3"])
+    controller = UiController(lines, "", find_matches, False, True)
+    controller.setup(create_screen())
+    controller.process_inputs("z")
+    lines._add_lines(["z arrived"])
+    while controller.is_busy():
+        controller.update()
+    assert controller._matches == [3]
+    assert "among 4 lines" in controller._get_status_text()
+
+@pytest.mark.parametrize("term", [
+    "one",
+    "ONE",
+    "one th",
+    "Them",
+    "the !one",
+    "!!one",
+    "hem two",
+    "/test",
+    "i̇st",
+    "xyz",
+])
+@pytest.mark.parametrize("indices", [None, range(1, 4), [0, 2, 5]])
+@pytest.mark.parametrize("chunk_size", [2, 10000])
+def test_trigram_index_gives_same_result_as_search(
+    monkeypatch,
+    term,
+    indices,
+    chunk_size
+):
+    monkeypatch.setattr(TrigramIndex, "INDEX_CHUNK_SIZE", chunk_size)
+    lines = Lines([
+        "one of them",
+        "two",
+        "ONE OF THEM",
+        "!one",
+        "/tests/test",
+        "İstanbul",
+    ])
+    assert list(TrigramIndex(lines).search(lines, term, indices)) == [
+        index
+        for (index, _)
+        in search(lines, term, indices)
+    ]
+
+def test_parallel_search_gives_same_result_as_search(monkeypatch):
+    monkeypatch.setattr(ParallelSearch, "MIN_LINES", 0)
+    monkeypatch.setattr("os.cpu_count", lambda: 2)
+    monkeypatch.setattr(SearchResult, "BLOCK_SIZE", 2)
+    lines = Lines(["one", "two", "three", "tHree", "x one", "\udcff one"])
+    parallel_search = ParallelSearch()
+    try:
+        for term in ["o", "one", "H", "e !t"]:
+            assert SearchResult(lines, term, parallel_search).fetch() == list(
+                find_matches(lines, term)
+            )
+    finally:
+        parallel_search.close()
+
+def test_parallel_search_scans_buffer_of_small_inputs(monkeypatch):
+    monkeypatch.setattr(
+        "rlselect.find_matches",
+        Mock(side_effect=AssertionError("lines matched one by one"))
+    )
+    lines = Lines(["one", "tHree", "Hi"])
+    parallel_search = ParallelSearch()
+    try:
+        assert list(parallel_search(lines, "H")) == [1, 2]
+        assert [
+            list(matches)
+            for matches
+            in parallel_search.map_blocks(lines, "H", [range(2), range(2, 3)])
+        ] == [[1], [2]]
+    finally:
+        parallel_search.close()
+
+def test_parallel_search_workers_are_closed_with_last_share(monkeypatch):
+    monkeypatch.setattr(ParallelSearch, "MIN_LINES", 0)
+    monkeypatch.setattr("os.cpu_count", lambda: 2)
+    lines = Lines(["one", "two", "three"])
+    parallel_search = ParallelSearch()
+    shared = parallel_search.share()
+    try:
+        parallel_search.close()
+        assert SearchResult(lines, "t", shared).fetch() == [1, 2]
+    finally:
+        shared.close()
+    assert shared._workers._pool is None
+
+@pytest.mark.parametrize("items", [
+    ["a", "b", "a", "c", "b"],
+    [str(x % 37) for x in range(100)],
+    [u"åäö", u"漢字", u"\udcff", u"", u"åäö"],
+    ["one\ntwo", "three", "one\ntwo", ""],
+])
+def test_lines_keep_first_unique_items(items):
+    lines = Lines(items)
+    expected = list(dict.fromkeys(items))
+    assert lines.count() == len(expected)
+    assert [lines.get(index) for index in range(lines.count())] == expected
+    assert list(lines.iter()) == list(enumerate(expected))
+    assert list(lines.iter(range(1, 3))) == list(enumerate(expected))[1:3]
+    assert list(lines.iter([0, 2])) == [(0, expected[0]), (2, expected[2])]
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1024])
+def test_mapped_lines_from_file(tmpdir, monkeypatch, chunk_size):
+    monkeypatch.setattr(MappedLines, "CHUNK_SIZE", chunk_size)
+    text = u"one\r\ntwo\n\nåäö\none\nthree\r\n\nlast"
+    tmpdir.join("lines.txt").write_binary(text.encode("utf-8"))
+    lines = MappedLines(str(tmpdir.join("lines.txt")))
+    lines.read_offsets()
+    assert list(lines.iter()) == list(Lines.from_stream(StringIO(text)).iter())
+
+@pytest.mark.parametrize("chunk_size", [1, 1024])
+def test_mapped_lines_remove_escapes_before_finding_duplicates(
+    tmpdir,
+    monkeypatch,
+    chunk_size
+):
+    monkeypatch.setattr(MappedLines, "CHUNK_SIZE", chunk_size)
+    text = u"\x1b[32mdup\x1b[0m\r\nother\ndup\n\x1b[1mother\n"
+    tmpdir.join("lines.txt").write_binary(text.encode("utf-8"))
+    lines = MappedLines(str(tmpdir.join("lines.txt")), no_ansi_esc=True)
+    lines.read_offsets()
+    assert list(lines.iter()) == [(0, "dup"), (1, "other")]
+    assert lines.get_colors(0) == ((0, 3, "ansi:2::"),)
+    assert lines.get_colors(1) == ()
+
+def test_mapped_line_with_undecodable_bytes_is_written_as_read(tmpdir):
+    tmpdir.join("lines.txt").write_binary(b"\xff\xfe bad\n")
+    output = subprocess.check_output([
+        sys.executable,
+        "-c",
+        "import sys, rlselect; "
+        "lines = rlselect.MappedLines(sys.argv[1]); "
+        "lines.read_offsets(); "
+        "rlselect.write_line(lines.get(0))",
+        str(tmpdir.join("lines.txt")),
+    ], cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert output == b"\xff\xfe bad\n"
+
+def test_mapped_lines_from_empty_file(tmpdir):
+    tmpdir.join("empty.txt").write_binary(b"")
+    lines = MappedLines(str(tmpdir.join("empty.txt")))
+    lines.read_offsets()
+    assert lines.count() == 0
+
+@pytest.mark.parametrize("mode,items,term,expected", [
+    ("lower", ["İstanbul", "stan"], "stan", [(0, [(1, 5)]), (1, [(0, 4)])]),
+    ("lower", ["Straße"], "strasse", []),
+    ("casefold", ["Straße", "STRASSE"], "strasse", [
+        (0, [(0, 6)]),
+        (1, [(0, 7)]),
+    ]),
+    ("casefold", ["Straße"], "aß", [(0, [(3, 5)])]),
+    ("accents", ["Café crème", "cafe"], "cafe cre", [(0, [(0, 4), (5, 8)])]),
+    ("accents", ["Café"], "fe", [(0, [(2, 4)])]),
+    ("accents", ["Café"], "Café", [(0, [(0, 4)])]),
+    ("accents", ["Cafe"], "Café", []),
+])
+@pytest.mark.parametrize("mapped", [False, True])
+def test_fold_modes(tmpdir, mapped, mode, items, term, expected):
+    if mapped:
+        path = tmpdir.join("lines.txt")
+        path.write_binary("".join(item + "\n" for item in items).encode("utf-8"))
+        lines = MappedLines(str(path))
+        lines.read_offsets()
+    else:
+        lines = Lines(items)
+    lines.set_fold_mode(mode)
+    assert list(search(lines, term)) == expected
+    assert list(TrigramIndex(lines).search(lines, term)) == [
+        index
+        for (index, _)
+        in expected
+    ]
+
+def test_highlights_only_rendered_matches():
+    highlighted = []
+    def search_fn(lines, term, indices):
+        return find_matches(lines, term, indices)
+    def highlight_fn(lines, term, index):
+        highlighted.append(index)
+        return [(0, 1)]
+    search_fn.highlight = highlight_fn
+    controller = UiController(
+        Lines(["a{}".format(x) for x in range(100)]),
+        "a",
+        search_fn,
+        False,
+        True
+    )
+    screen = create_screen(5)
+    controller.setup(screen)
+    controller.render(screen)
+    controller.render(screen)
+    assert controller._total_nbr_of_matched_lines == 100
+    assert highlighted == [1, 2]
+
+
+def test_long_lines_are_shown_around_first_highlight():
+    line = "x" * 1000 + "match" + "y" * 1000
+    controller = UiController(
+        Lines([line + "1", line + "2"]),
+        "match",
+        find_matches,
+        False,
+        False
+    )
+    screen = create_screen(4, 20)
+    controller.setup(screen)
+    controller.render(screen)
+    screen.addstr.assert_any_call(2, 0, "x" * 10 + "match" + "y" * 5, "select")
+    screen.addstr.assert_any_call(3, 0, "x" * 10, "default")
+    screen.addstr.assert_any_call(3, 10, "match", "highlight")
+    screen.addstr.assert_any_call(3, 15, "y" * 5, "default")
+
+@pytest.mark.parametrize("text,width,expected", [
+    ("abc", 2, ("ab", 2)),
+    ("a\tb", 4, ("a", 1)),
+    ("a\tb", 6, ("a\tb", 6)),
+    ("\u65e5\u672c\u8a9e", 5, ("\u65e5\u672c", 4)),
+    ("e\u0301x", 2, ("e\u0301x", 2)),
+])
+def test_fit_display_width(text, width, expected):
+    assert fit_display_width(text, width) == expected
+
+def test_default_search_fn_yields_indices():
+    args = {"--fuzzy": False, "--index": False, "--x-status": False}
+    lines = Lines(["abc", "abd", "xyz"])
+    assert list(get_search_fn(args, lines)(lines, "ab", None)) == [0, 1]
+
+
+def test_query_checks_least_frequent_terms_first():
+    (lower, condition, names) = compile_query(
+        "aa b !c b", sample=["aa", "aa b", "aa c"]
+    )
+    assert lower
+    assert condition == (
+        "t0 in line and t1 in line and (t2 not in line or t3 in line)"
+    )
+    assert names == {"t0": "b", "t1": "aa", "t2": "c", "t3": "!c"}
+
+@pytest.mark.parametrize("min_scanned_lines", [1, 100])
+def test_multi_term_search_matches_like_find_matches(
+        monkeypatch, min_scanned_lines):
+    monkeypatch.setattr(
+        MultiTermSearch, "MIN_SCANNED_LINES", min_scanned_lines
+    )
+    lines = Lines([
+        "abc", "abd", "xbc", "a!b", "ABC", "ab", "caf\u00e9", "!", "", "bcab"
+    ])
+    lines.set_fold_mode("accents")
+    for expression in [
+        "", "ab", "ab bc", "ab abc", "b !bd", "!a", "!!b", "!!", "AB",
+        "Ab b", "cafe", "a !a", "c a",
+    ]:
+        for indices in [None, range(3, 10), [0, 2, 4]]:
+            assert list(MultiTermSearch()(lines, expression, indices)) == (
+                list(find_matches(lines, expression, indices))
+            )
+
+def test_fuzzy_search_matches_characters_in_order():
+    lines = Lines(["src/rlselect.py", "README.md", "res/lib.py", "sel"])
+    assert list(FuzzySearch()(lines, "rsl", None)) == [0, 2]
+    assert list(FuzzySearch()(lines, "rsl !lib", None)) == [0]
+    assert list(FuzzySearch()(lines, "RM", None)) == [1]
+
+def test_fuzzy_search_scores_boundaries_and_runs_higher():
+    lines = Lines(["xaxbxc", "abc", "a/b/c", "xabc"])
+    fuzzy = FuzzySearch()
+    scores = list(fuzzy.score(lines, "abc", range(4)))
+    assert scores[0] < scores[3] < scores[2] < scores[1]
+
+def test_fuzzy_search_highlights_matched_characters():
+    lines = Lines(["xaxbxc", "xxabc"])
+    assert FuzzySearch().highlight(lines, "abc", 0) == [(1, 2), (3, 4), (5, 6)]
+    assert FuzzySearch().highlight(lines, "abc", 1) == [(2, 5)]
+
+def test_fuzzy_search_shows_best_matches_first():
+    lines = Lines(["a_x_b_x_c{}".format(x) for x in range(5)] + ["abc", "xabc"])
+    controller = UiController(lines, "abc", FuzzySearch(), False, False)
+    screen = create_screen(5)
+    controller.setup(screen)
+    assert controller._matches == [5, 6, 0]
+    assert controller._total_nbr_of_matched_lines == 7
+
+
+def test_going_back_to_a_term_reuses_its_result():
+    searched = []
+    def search_fn(lines, term, indices):
+        searched.append(term)
+        return find_matches(lines, term, indices)
+    controller = UiController(
+        Lines(["abc", "abd", "xyz"]), "", search_fn, False, False
+    )
+    controller.setup(create_screen())
+    controller.process_input("a")
+    controller.process_input("b")
+    result = controller._result
+    controller.process_input("c")
+    del searched[:]
+    controller.process_input(BS)
+    assert controller._result is result
+    assert controller._matches == [0, 1]
+    assert searched == []
+    controller.process_input(CTRL_W)
+    controller.process_input("a")
+    assert searched == []
+
+def test_refinement_starts_from_closest_cached_term():
+    searched = []
+    def search_fn(lines, term, indices):
+        searched.extend(indices)
+        return find_matches(lines, term, indices)
+    controller = UiController(
+        Lines(["abc", "abd", "xyz"]), "ab", search_fn, False, True
+    )
+    controller.setup(create_screen())
+    controller.process_input("c")
+    controller.process_input(BS)
+    controller.process_input(BS)
+    controller.process_input(BS)
+    del searched[:]
+    controller.process_input("a")
+    controller.process_input("b")
+    controller.process_input("d")
+    assert searched == [0, 1]
+    assert controller._matches == [1]
+
+def test_result_cache_evicts_least_recently_used(monkeypatch):
+    monkeypatch.setattr(UiController, "RESULT_CACHE_SIZE", 7)
+    controller = UiController(
+        Lines(["a", "b", "c"]), "", find_matches, False, True
+    )
+    controller.setup(create_screen())
+    for term in ["a", "b", "c"]:
+        controller.process_input(term)
+        controller.process_input(BS)
+    assert list(controller._results) == ["c"]
+    assert controller._term == ""
+
+
+def test_resize_reuses_matches():
+    controller = UiController(
+        Lines(["a{}".format(x) for x in range(10)]),
+        "a",
+        find_matches,
+        False,
+        False
+    )
+    controller.setup(create_screen(6))
+    controller.process_input(CTRL_P)
+    result = controller._result
+    controller.resize(create_screen(4))
+    assert controller._result is result
+    assert controller._matches == [0, 1]
+    assert controller._match_highlight == 1
+    controller.resize(create_screen(8))
+    assert controller._matches == [0, 1, 2, 3, 4, 5]
+
+
+def test_scrolling_fetches_more_matches_of_same_search():
+    controller = UiController(
+        Lines(["a{}".format(x) for x in range(10)]),
+        "a",
+        find_matches,
+        False,
+        False
+    )
+    controller.setup(create_screen(4))
+    result = controller._result
+    controller.process_inputs(CTRL_N + CTRL_N)
+    assert controller._result is result
+    assert controller._matches == [0, 1, 2]
+    screen = create_screen(4)
+    controller.render(screen)
+    screen.addstr.assert_any_call(2, 1, "1", "default")
+    screen.addstr.assert_any_call(3, 0, "a2".ljust(100), "select")
+
+def test_paging_stops_at_last_match_and_next_wraps():
+    controller = UiController(
+        Lines(["a{}".format(x) for x in range(5)]),
+        "a",
+        find_matches,
+        False,
+        False
+    )
+    controller.setup(create_screen(4))
+    controller.process_inputs(CTRL_F + CTRL_F + CTRL_F)
+    assert controller._match_highlight == 4
+    controller.process_inputs(CTRL_B)
+    assert controller._match_highlight == 2
+    controller.process_inputs(CTRL_N + CTRL_N + CTRL_N)
+    assert controller._match_highlight == 0
+    assert controller._scroll == 0
+
+def test_paging_with_extended_status_shows_full_page():
+    controller = UiController(
+        Lines(["a{}".format(x) for x in range(20)]),
+        "a",
+        find_matches,
+        False,
+        True
+    )
+    controller.setup(create_screen(5))
+    controller.process_inputs(CTRL_F)
+    assert controller._get_visible_matches() == [(3, 3), (4, 4), (5, 5)]
+
+def test_typed_ahead_characters_are_searched_once():
+    searched = []
+    def search_fn(lines, term, indices):
+        searched.append(term)
+        return find_matches(lines, term, indices)
+    controller = UiController(
+        Lines(["abc", "abd", "xyz"]), "", search_fn, False, False
+    )
+    controller.setup(create_screen())
+    del searched[:]
+    controller.process_inputs("abx" + BS + "d")
+    assert searched == ["abd"]
+    assert controller.process_inputs("x" + BS + CR + "y") == (
+        Action(False, "enter"),
+        "abd"
+    )
+
+
+def test_top_matches_are_scored_until_deadline(monkeypatch):
+    monkeypatch.setattr(TopMatches, "BLOCK_SIZE", 2)
+    top_matches = TopMatches(lambda indices: indices, 2)
+    assert top_matches.update([1, 5, 3, 4], deadline=0) == [5, 1]
+    assert not top_matches.is_complete()
+    assert top_matches.update([1, 5, 3, 4, 2]) == [5, 4]
+    assert top_matches.is_complete()
+
+
+def test_stats_are_written_as_json_lines(tmpdir):
+    stats = Stats()
+    with stats.time("nothing") as fields:
+        fields["lines"] = 1
+    stats.open(str(tmpdir.join("stats.jsonl")))
+    with stats.time("search", term="a") as fields:
+        fields["matches"] = 2
+    stats._file.flush()
+    [record] = [
+        json.loads(line)
+        for line
+        in tmpdir.join("stats.jsonl").read().splitlines()
+    ]
+    assert record["phase"] == "search"
+    assert record["term"] == "a"
+    assert record["matches"] == 2
+    assert record["seconds"] >= 0
+    if os.path.exists("/proc/self/statm"):
+        assert record["memory_bytes"] > 0
+
+
+def test_filter_lines_streams_batches():
+    batches = iter([["abc", "x", "abd"], ["abc", "ab"], ["never read"]])
+    match = get_filter_match_fn("ab")
+    assert list(filter_lines(batches, match)) == [
+        ["abc", "abd"],
+        ["abc", "ab"],
+        [],
+    ]
+
+def test_filter_lines_unique_and_limit():
+    batches = iter([["abc", "abc", "x"], ["abc", "ab", "abd"], ["ab"]])
+    match = get_filter_match_fn("ab")
+    assert list(filter_lines(batches, match, unique=True, limit=2)) == [
+        ["abc"],
+        ["ab"],
+    ]
+    assert next(batches) == ["ab"]
+
+def test_filter_rejects_limit_that_is_not_a_number():
+    process = subprocess.run([
+        sys.executable,
+        "rlselect.py",
+        "--filter", "a",
+        "--limit", "x",
+    ], input=b"a\n", capture_output=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert process.returncode == 1
+    assert b"Usage:" in process.stdout
+
+def test_filter_match_fn_folds_lines():
+    assert get_filter_match_fn("strasse", "casefold")("Straße")
+    assert get_filter_match_fn("cafe", "accents")("Café")
+    assert not get_filter_match_fn("cafe")("Café")
+    assert get_filter_match_fn("rsl", fuzzy=True)("src/rlselect.py")
+
+
+def test_read_history_is_newest_first_and_cached(tmpdir):
+    history = tmpdir.join("history")
+    cache_path = str(tmpdir.join("cache"))
+    history.write("ls\ncd\nls\nvim\n")
+    assert get_all(read_history(str(history), cache_path)) == [
+        "vim", "ls", "cd"
+    ]
+    assert tmpdir.join("cache").check()
+    assert get_all(read_history(str(history), cache_path)) == [
+        "vim", "ls", "cd"
+    ]
+    history.write("cd\nmake\n", mode="a")
+    lines = read_history(str(history), cache_path)
+    assert get_all(lines) == ["make", "cd", "vim", "ls"]
+    lines._add_lines(["ls", "git"])
+    assert get_all(lines) == ["make", "cd", "vim", "ls", "git"]
+    assert get_all(read_history(str(history), cache_path)) == [
+        "make", "cd", "vim", "ls"
+    ]
+
+def test_read_history_rereads_rewritten_file(tmpdir):
+    history = tmpdir.join("history")
+    cache_path = str(tmpdir.join("cache"))
+    history.write("ls\ncd\nvim\n")
+    read_history(str(history), cache_path)
+    history.write("cd\nvim\nmake\ngit\n")
+    assert get_all(read_history(str(history), cache_path)) == [
+        "git", "make", "vim", "cd"
+    ]
+
+def test_read_history_of_missing_file_is_empty(tmpdir):
+    history = tmpdir.join("history")
+    cache_path = str(tmpdir.join("cache"))
+    assert get_all(read_history(str(history), cache_path)) == []
+    assert not tmpdir.join("cache").check()
+
+def test_history_line_with_undecodable_bytes_is_written_as_read(tmpdir):
+    history = tmpdir.join("history")
+    history.write_binary(b"ls\n\xff\xfe bad\n")
+    output = subprocess.check_output([
+        sys.executable,
+        "-c",
+        "import sys, rlselect; "
+        "lines = rlselect.read_history(sys.argv[1]); "
+        "rlselect.write_line(lines.get(0))",
+        str(history),
+    ], cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert output == b"\xff\xfe bad\n"
+
+def get_all(lines):
+    return [line for (_, line) in lines.iter()]
+
+def test_daemon_controller_selects_among_lines_of_file(tmpdir):
+    path = tmpdir.join("lines")
+    path.write("one\ntwo\nthree\n")
+    (daemon, controller) = connect_to_daemon(str(path))
+    controller.setup(create_screen())
+    controller.process_inputs("tw")
+    while controller.is_busy():
+        controller.update()
+    screen = create_screen()
+    controller.render(screen)
+    screen.addstr.assert_any_call(0, 0, "> tw", "default")
+    assert controller.process_inputs(CR) == (Action(False, "enter"), "two")
+
+@pytest.mark.parametrize("text", ["one\ntwo\n", "ONE\ntwo\n"])
+def test_daemon_reads_changed_file_again(tmpdir, text):
+    path = tmpdir.join("lines")
+    path.write("one\n")
+    (daemon, controller) = connect_to_daemon(str(path))
+    controller.setup(create_screen())
+    while controller.is_busy():
+        controller.update()
+    path.write(text)
+    (_, controller) = connect_to_daemon(str(path), daemon)
+    controller.setup(create_screen())
+    controller.process_inputs("t")
+    while controller.is_busy():
+        controller.update()
+    assert controller.process_inputs(CR) == (Action(False, "enter"), "two")
+
+def test_daemon_adds_lines_appended_to_file(tmpdir):
+    path = tmpdir.join("lines")
+    path.write("one\n")
+    daemon = Daemon()
+    args = {
+        "--file": str(path),
+        "--history": None,
+        "--no-ansi-esc": False,
+        "--fold": "lower",
+    }
+    source = daemon.get_source(args)
+    while source.lines.is_loading():
+        time.sleep(0.01)
+    path.write("two\none\n", mode="a")
+    assert daemon.get_source(args) is source
+    while source.lines.is_loading():
+        time.sleep(0.01)
+    assert get_all(source.lines) == ["one", "two"]
+    path.write("three\n")
+    assert daemon.get_source(args) is not source
+
+def test_mapped_lines_stop_reading_when_cancelled(tmpdir, monkeypatch):
+    monkeypatch.setattr(MappedLines, "CHUNK_SIZE", 1)
+    tmpdir.join("lines.txt").write("one\ntwo\n")
+    lines = MappedLines(str(tmpdir.join("lines.txt")))
+    lines.cancel()
+    lines.read_offsets()
+    assert lines.count() == 0
+    assert not lines.read_appended_in_background()
+
+def connect_to_daemon(path, daemon=None, options=()):
+    daemon = daemon or Daemon()
+    (server, client) = socket.socketpair()
+    threading.Thread(
+        target=daemon.serve,
+        args=(server.makefile("rb"), server.makefile("wb")),
+        daemon=True
+    ).start()
+    args = dict((name, None) for name in DAEMON_ARGS)
+    args.update({
+        "--file": path,
+        "--fold": "lower",
+        "<initial-search-term>": [],
+    })
+    args.update(dict((option, True) for option in options))
+    return (daemon, RemoteController(client, args))
+
+def test_daemon_sessions_do_not_cancel_each_others_searches(
+    tmpdir,
+    monkeypatch
+):
+    monkeypatch.setattr(ParallelSearch, "MIN_LINES", 0)
+    monkeypatch.setattr("os.cpu_count", lambda: 2)
+    monkeypatch.setattr(SearchResult, "BLOCK_SIZE", 1)
+    path = tmpdir.join("lines")
+    path.write("".join("a{}\nb{}\n".format(x, x) for x in range(1000)))
+    (daemon, first) = connect_to_daemon(str(path), options=["--x-status"])
+    (_, second) = connect_to_daemon(str(path), daemon, ["--x-status"])
+    first.setup(create_screen())
+    second.setup(create_screen())
+    first.process_inputs("a")
+    second.process_inputs("b")
+    for controller in [first, second]:
+        while controller.is_busy():
+            controller.update()
+        screen = create_screen()
+        controller.render(screen)
+        screen.addstr.assert_any_call(
+            1,
+            0,
+            "1000 lines matched, 98 lines visible, among 2,000 lines ".rjust(100),
+            "status"
+        )